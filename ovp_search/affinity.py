@@ -0,0 +1,35 @@
+from django.core.cache import cache
+
+"""
+The affinity of a user is the list of causes and skills on their profile.
+It is used to rank projects by relevance on the search engine and is
+invalidated by TiedModelRealtimeSignalProcessor when the profile changes.
+"""
+
+AFFINITY_TTL = 60 * 60 * 24
+
+
+def get_affinity_key(user_pk):
+  return 'search-affinity-{}'.format(user_pk)
+
+
+def get_affinity(user):
+  """ Returns a dict with sorted cause and skill ids for user """
+  key = get_affinity_key(user.pk)
+  affinity = cache.get(key)
+
+  if affinity is None:
+    affinity = {"causes": [], "skills": []}
+    profile = user.profile
+
+    if profile:
+      affinity["causes"] = sorted(profile.causes.values_list('id', flat=True))
+      affinity["skills"] = sorted(profile.skills.values_list('id', flat=True))
+
+    cache.set(key, affinity, AFFINITY_TTL)
+
+  return affinity
+
+
+def invalidate_affinity(user_pk):
+  cache.delete(get_affinity_key(user_pk))
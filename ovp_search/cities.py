@@ -0,0 +1,116 @@
+from django.db import transaction
+from django.db.models import F, Q
+
+from ovp_projects.models import Project
+from ovp_organizations.models import Organization
+
+from ovp_search import helpers
+from ovp_search.models import CountryCity, CountryCityReference
+
+"""
+Available cities per country
+
+Each listed project or organization holds a reference to the cities it
+is counted on. Counts are updated by the difference between the cities
+an object was counted on and the ones it should be counted on now.
+"""
+
+KINDS = {
+  Project: 'projects',
+  Organization: 'organizations',
+}
+
+
+def is_listed(obj):
+  """ Only published projects and organizations are listed, projects must also be open """
+  if obj.deleted or not obj.published:
+    return False
+
+  if isinstance(obj, Project):
+    return not obj.closed
+
+  return True
+
+
+def get_object_cities(obj):
+  """ Returns a set of (country, city) tuples an object should be counted on """
+  if not is_listed(obj) or not obj.address_id:
+    return set()
+
+  components = helpers.get_address_components(obj.address)
+  countries = [c[:-len('-country')] for c in components if c.endswith('-country')]
+  cities = helpers.get_cities(dict.fromkeys(components, 1))
+
+  return set((country, city) for country in countries for city in cities)
+
+
+@transaction.atomic
+def set_object_cities(kind, object_id, country_cities):
+  """ Count an object on country_cities only """
+  references = CountryCityReference.objects.filter(kind=kind, object_id=object_id).select_related('country_city')
+  current = {(r.country_city.country, r.country_city.city): r for r in references}
+
+  removed = [r for key, r in current.items() if key not in country_cities]
+  if removed:
+    CountryCity.objects.filter(pk__in=[r.country_city_id for r in removed]).update(**{kind: F(kind) - 1})
+    CountryCityReference.objects.filter(pk__in=[r.pk for r in removed]).delete()
+
+  for country, city in country_cities - set(current):
+    country_city, created = CountryCity.objects.get_or_create(country=country, city=city)
+    CountryCity.objects.filter(pk=country_city.pk).update(**{kind: F(kind) + 1})
+    CountryCityReference.objects.create(country_city=country_city, kind=kind, object_id=object_id)
+
+
+def update_object(obj):
+  kind = KINDS.get(obj.__class__, None)
+  if kind and obj.pk:
+    set_object_cities(kind, obj.pk, get_object_cities(obj))
+
+
+def remove_object(obj):
+  kind = KINDS.get(obj.__class__, None)
+  if kind and obj.pk:
+    set_object_cities(kind, obj.pk, set())
+
+
+def get_available_cities(country):
+  """ Returns cities with projects, organizations or both for a country """
+  result = {"projects": [], "organizations": [], "common": []}
+
+  queryset = CountryCity.objects.filter(Q(projects__gt=0) | Q(organizations__gt=0), country=country)
+  for city, projects, organizations in queryset.values_list('city', 'projects', 'organizations'):
+    if projects and organizations:
+      result["common"].append(city)
+    elif projects:
+      result["projects"].append(city)
+    else:
+      result["organizations"].append(city)
+
+  for key in result:
+    result[key].sort()
+
+  return result
+
+
+@transaction.atomic
+def rebuild():
+  """ Rebuild all counts from scratch. Returns the number of country cities """
+  CountryCityReference.objects.all().delete()
+  CountryCity.objects.all().delete()
+
+  counts = {}
+  references = []
+
+  for model, kind in KINDS.items():
+    queryset = model.objects.filter(published=True, deleted=False).select_related('address')
+
+    for obj in queryset.iterator():
+      for country_city in get_object_cities(obj):
+        counts.setdefault(country_city, {'projects': 0, 'organizations': 0})[kind] += 1
+        references.append((country_city, kind, obj.pk))
+
+  CountryCity.objects.bulk_create([CountryCity(country=country, city=city, **c) for (country, city), c in counts.items()])
+  ids = {(c.country, c.city): c.pk for c in CountryCity.objects.all()}
+  CountryCityReference.objects.bulk_create([CountryCityReference(country_city_id=ids[country_city], kind=kind, object_id=object_id) for country_city, kind, object_id in references])
+
+  return len(counts)
@@ -0,0 +1,100 @@
+from django.dispatch import receiver
+from django.test.signals import setting_changed
+from django.utils.encoding import force_text
+from haystack import connection_router, connections
+from haystack.query import SQ
+
+from functools import lru_cache
+
+"""
+Query compiler
+
+Keyword fields, such as address_components, causes and skills, are
+filtered by exact terms. Whoosh, Solr and Elasticsearch get the terms as
+narrow queries, which are applied as filters the engines can cache apart
+from the scored query: Solr sends them as fq and Elasticsearch as bool
+filters.
+
+Solr and Elasticsearch match terms on the faceted field, which is not
+analyzed. Other backends fall back to filtering the field by its values.
+
+Compilers are resolved once per connection alias, see get_compiler.
+"""
+
+
+class QueryCompiler(object):
+  """ Filters keyword fields by their values on the search query """
+  def __init__(self, using):
+    self.using = using
+    self.unified_index = connections[using].get_unified_index()
+
+  def filter(self, queryset, field, values, operator=SQ.OR):
+    """ Filter queryset by documents with any(SQ.OR) or all(SQ.AND) of values on field """
+    q_obj = SQ()
+    for value in values:
+      q_obj.add(SQ(**{field: value}), operator)
+    return queryset.filter(q_obj)
+
+
+class TermQueryCompiler(QueryCompiler):
+  """ Filters keyword fields by exact terms on Solr and Elasticsearch """
+  def get_fieldname(self, field):
+    return self.unified_index.get_facet_fieldname(field)
+
+  def quote(self, value):
+    return u'"{}"'.format(value.replace('\\', '\\\\').replace('"', '\\"'))
+
+  def terms(self, field, values, operator=SQ.OR):
+    """ Returns a narrow query matching values on field """
+    terms = u' {} '.format(operator).join(self.quote(force_text(value)) for value in values)
+    return u'{}:({})'.format(self.get_fieldname(field), terms)
+
+  def filter(self, queryset, field, values, operator=SQ.OR):
+    values = list(values)
+    if not values:
+      return queryset
+    return queryset.narrow(self.terms(field, values, operator))
+
+
+class WhooshQueryCompiler(TermQueryCompiler):
+  """
+  Filters keyword fields by exact terms on Whoosh
+
+  Keyword fields are not analyzed besides splitting on commas. Whoosh
+  phrases can't escape double quotes, so values with them are single
+  quoted instead.
+  """
+  def get_fieldname(self, field):
+    return self.unified_index.get_index_fieldname(field)
+
+  def quote(self, value):
+    if '"' in value:
+      return u"'{}'".format(value)
+    return u'"{}"'.format(value)
+
+
+def get_compiler_class(using):
+  engine = connections[using].__class__.__name__
+
+  # Also matches engines extending them, such as BufferedWhooshEngine
+  if engine.endswith("WhooshEngine"):
+    return WhooshQueryCompiler
+  if "Solr" in engine or "Elasticsearch" in engine: # pragma: no cover
+    return TermQueryCompiler
+  return QueryCompiler # pragma: no cover
+
+
+@lru_cache()
+def get_alias_compiler(using):
+  return get_compiler_class(using)(using)
+
+
+def get_compiler(using=None):
+  """ Returns the query compiler for a connection alias """
+  return get_alias_compiler(using or connection_router.for_read())
+
+
+@receiver(setting_changed)
+def clear_compilers(setting, **kwargs):
+  if setting == 'HAYSTACK_CONNECTIONS':
+    get_alias_compiler.cache_clear()
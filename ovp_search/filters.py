@@ -1,67 +1,89 @@
 from ovp_search import helpers
-from haystack.query import SQ
+from ovp_search import affinity
+from ovp_search import compiler
+from ovp_search import geo
+from ovp_search.query import DATETIME_FORMAT
+from haystack.query import SearchQuerySet, SQ
 
 from rest_framework.filters import OrderingFilter
 from rest_framework.exceptions import NotAuthenticated
 
-from django.db.models import When, F, IntegerField, Count, Case
+from django.test.signals import setting_changed
+from django.dispatch import receiver
+from django.utils import timezone
 
+from functools import lru_cache
+import datetime
 import json
 
+# Number of compiled address filters kept
+ADDRESS_PLAN_CACHE_SIZE = 1024
+
 #####################
 ## ViewSet filters ##
 #####################
 
-class ProjectRelevanceOrderingFilter(OrderingFilter):
-  def get_skills_and_causes(self, request):
-    if not request.user.is_authenticated():
-      raise NotAuthenticated()
-
-    user = request.user
-    output = {"skills": [], "causes": []}
-
-    if user.profile:
-      output["skills"] = user.profile.skills.values_list('id', flat=True)
-      output["causes"] = user.profile.causes.values_list('id', flat=True)
-
-    return output
-
-  def annotate_queryset(self, queryset, request):
-    self.get_skills_and_causes(request)
-
-    queryset = queryset\
-                .annotate(\
-                  cause_relevance =
-                    Count(
-                      Case(When(causes__pk__in=[1,3], then=1),
-                           output_field=IntegerField()),
-                      distinct=True),
-                  skill_relevance =
-                    Count(
-                      Case(When(skills__pk__in=[1,2,4], then=1),
-                                output_field=IntegerField()),
-                      distinct=True))\
-                .annotate(relevance = F('cause_relevance') + F('skill_relevance'))
+class DistanceOrderingFilter(OrderingFilter):
+  """
+  Ordering by distance is computed on radius searches, see geo.within.
 
-    return queryset
+  Search querysets are returned as is. On database querysets distance
+  maps to the position of each result on the primary keys searched.
+  """
+  position_ordering = {
+    'distance': 'search_position',
+    '-distance': '-search_position',
+  }
 
   def filter_queryset(self, request, queryset, view):
+    if isinstance(queryset, SearchQuerySet):
+      return queryset
+
     ordering = self.get_ordering(request, queryset, view)
 
-    if ordering:
-      if "relevance" in ordering or "-relevance" in ordering:
-        queryset = self.annotate_queryset(queryset, request)
+    # Results hydrated in chunks are lists in the search engine order, which can only be reversed
+    if isinstance(queryset, list):
+      if ordering and self.position_ordering.get(ordering[0]) == '-search_position':
+        return queryset[::-1]
+      return queryset
 
     if ordering:
+      ordering = [self.position_ordering.get(field, field) for field in ordering]
       return queryset.order_by(*ordering)
 
     return queryset
 
 
+class ProjectRelevanceOrderingFilter(DistanceOrderingFilter):
+  """
+  Ordering by relevance is ranked by the search engine, see by_relevance.
+
+  Search querysets are already ranked. On database querysets relevance
+  maps to the position returned by the search engine.
+  """
+  relevance_ordering = {
+    '-relevance': 'search_position',
+    'relevance': '-search_position',
+  }
+  position_ordering = dict(DistanceOrderingFilter.position_ordering, **relevance_ordering)
+
+
+def get_relevance_affinity(request):
+  """ Returns causes and skills used to rank results for the request user """
+  if not request.user.is_authenticated():
+    raise NotAuthenticated()
+
+  return affinity.get_affinity(request.user)
+
+
 ######################
 ## Haystack filters ##
 ######################
 
+def get_compiler(queryset):
+  return compiler.get_compiler(queryset.query._using)
+
+
 def get_operator_and_items(string=''):
   items = string.split(',')
 
@@ -79,11 +101,8 @@ def by_skills(queryset, skill_string=None):
   """ Filter queryset by a comma delimeted skill list """
   if skill_string:
     operator, items = get_operator_and_items(skill_string)
-    q_obj = SQ()
-    for s in items:
-      if len(s) > 0:
-        q_obj.add(SQ(skills=s), operator)
-    queryset = queryset.filter(q_obj)
+    items = [s for s in items if len(s) > 0]
+    queryset = get_compiler(queryset).filter(queryset, 'skills', items, operator)
   return queryset
 
 
@@ -91,10 +110,63 @@ def by_causes(queryset, cause_string=None):
   """ Filter queryset by a comma delimeted cause list """
   if cause_string:
     operator, items = get_operator_and_items(cause_string)
+    items = [c for c in items if len(c) > 0]
+    queryset = get_compiler(queryset).filter(queryset, 'causes', items, operator)
+  return queryset
+
+
+def by_relevance(queryset, user_affinity=None):
+  """
+  Rank queryset by causes and skills in common with user_affinity
+
+  Every result matches the deleted clause, so results are not filtered,
+  but the ones matching more causes and skills get a higher score.
+  """
+  if user_affinity:
+    q_obj = SQ(deleted=0)
+    for c in user_affinity.get('causes', []):
+      q_obj.add(SQ(causes=c), SQ.OR)
+    for s in user_affinity.get('skills', []):
+      q_obj.add(SQ(skills=s), SQ.OR)
+    queryset = queryset.filter(q_obj)
+  return queryset
+
+
+def by_organizations(queryset, organization_string=None, exclude=False):
+  """ Filter queryset by a comma delimited organization id list, or exclude them """
+  if organization_string:
     q_obj = SQ()
-    for c in items:
-      if len(c) > 0:
-        q_obj.add(SQ(causes=c), operator)
+    for o in organization_string.split(','):
+      if len(o) > 0:
+        q_obj.add(SQ(organization=o), SQ.OR)
+    queryset = queryset.exclude(q_obj) if exclude else queryset.filter(q_obj)
+  return queryset
+
+
+def by_availability(queryset, start_after=None, end_before=None):
+  """
+  Filter queryset by job dates, normalized by query.normalize_datetime
+
+  Projects with work are ongoing, so they are available on any dates.
+  """
+  if start_after:
+    start_after = datetime.datetime.strptime(start_after, DATETIME_FORMAT).replace(tzinfo=timezone.utc)
+    queryset = queryset.filter(SQ(job_start_date__gte=start_after) | SQ(ongoing=1))
+  if end_before:
+    end_before = datetime.datetime.strptime(end_before, DATETIME_FORMAT).replace(tzinfo=timezone.utc)
+    queryset = queryset.filter(SQ(job_end_date__lte=end_before) | SQ(ongoing=1))
+  return queryset
+
+
+def by_location(queryset, location=None):
+  """ Filter queryset by the bounding box of a (lat, lng, radius) circle, see geo.within """
+  if location:
+    south, north, ranges = geo.get_bounding_box(*location)
+    queryset = queryset.filter(latitude__gte=round(south, 6), latitude__lte=round(north, 6))
+
+    q_obj = SQ()
+    for west, east in ranges:
+      q_obj.add(SQ(longitude__gte=round(west, 6), longitude__lte=round(east, 6)), SQ.OR)
     queryset = queryset.filter(q_obj)
   return queryset
 
@@ -116,54 +188,135 @@ def by_name(queryset, name=None):
   return queryset
 
 
+def collapse_components(term_sets):
+  """
+  Drop redundant components
+
+  Components are ANDed and their terms are ORed, so a component whose
+  terms include every term of another component doesn't narrow results.
+  """
+  term_sets = sorted(set(term_sets), key=len)
+  collapsed = []
+  for terms in term_sets:
+    if not any(kept <= terms for kept in collapsed):
+      collapsed.append(terms)
+  return collapsed
+
+
+@lru_cache(maxsize=ADDRESS_PLAN_CACHE_SIZE)
+def compile_address(address):
+  """
+  Compile an address parameter, normalized by query.normalize_address
+
+  Returns a tuple of ORed address_components terms for each component to
+  filter by, an empty tuple for remote projects or None if there's nothing
+  to filter. Region aliases compile to a single component with a term per
+  country.
+
+  Plans are cached per address and don't depend on the backend.
+  """
+  address = json.loads(address)
+  if u'address_components' not in address:
+    return None
+
+  components = address[u'address_components']
+  if not components:
+    return ()
+
+  regions = helpers.get_region_aliases()
+  if components[0][u'long_name'] in regions:
+    countries = regions[components[0][u'long_name']]
+    return (tuple(u"{}-country".format(country) for country in countries),)
+
+  term_sets = [frozenset(u"{}-{}".format(c[u'long_name'], t).strip() for t in c[u'types']) for c in components]
+  term_sets = [terms for terms in collapse_components(term_sets) if terms]
+
+  return tuple(tuple(sorted(terms)) for terms in term_sets)
+
+
+@receiver(setting_changed)
+def clear_address_plans(setting, **kwargs):
+  """ Region aliases are read from settings when compiling """
+  if setting == 'OVP_SEARCH':
+    compile_address.cache_clear()
+
+
 def by_address(queryset, address='', project=False):
   """
-  Filter queryset by publish status.
+  Filter queryset by address components
 
-  If project=True, we also apply a project exclusive filter
+  If project=True, addresses without components return remote projects.
   """
   if address:
-    address = json.loads(address)
-    if u'address_components' in address:
-      q_objs = []
-
-      """
-      Caribbean filter
-      """
-      if len(address[u'address_components']):
-        if address[u'address_components'][0]['long_name'] == 'Caribbean':
-          queryset = queryset.filter(
-            SQ(address_components=helpers.whoosh_raw(u"{}-{}".format('Jamaica', 'country').strip())) |
-            SQ(address_components=helpers.whoosh_raw(u"{}-{}".format('Haiti', 'country').strip())) |
-            SQ(address_components=helpers.whoosh_raw(u"{}-{}".format('Saint Lucia', 'country').strip())) |
-            SQ(address_components=helpers.whoosh_raw(u"{}-{}".format('Suriname', 'country').strip())) |
-            SQ(address_components=helpers.whoosh_raw(u"{}-{}".format('Trinidad & Tobago', 'country').strip()))
-          )
-
-          return queryset
-
-        for component in address[u'address_components']:
-          q_obj = SQ()
-          test = ''
-
-          for component_type in component[u'types']:
-            type_string = helpers.whoosh_raw(u"{}-{}".format(component[u'long_name'], component_type).strip())
-            q_obj.add(SQ(address_components=type_string), SQ.OR)
-
-          q_objs.append(q_obj)
-
-        # Filter all address components
-        for obj in q_objs:
-          queryset = queryset.filter(obj)
-      else: # remote projects
-        if project:
-          queryset = queryset.filter(can_be_done_remotely=1)
+    plan = compile_address(address)
+    if plan is None:
+      return queryset
+
+    if not plan:
+      if project:
+        queryset = queryset.filter(can_be_done_remotely=1)
+      return queryset
+
+    # Each component is a term filter, cached by the engine
+    query_compiler = get_compiler(queryset)
+    for terms in plan:
+      queryset = query_compiler.filter(queryset, 'address_components', terms)
+  return queryset
+
+def get_filter_out(setting_name):
+  """
+  Returns the exclusions configured for a resource
+  """
+  return helpers.get_settings().get(setting_name, {}).get('FILTER_OUT', {})
+
+def get_filter_out_query(setting_name, fields):
+  """
+  Translate the exclusions configured for a resource into a SQ
+
+  Only exact and in lookups on primary keys or fields in fields can run on
+  the search engine. Returns None if any lookup can't, as exclusions only
+  hold when all of them are applied together.
+  """
+  q_obj = SQ()
+  for lookup, value in get_filter_out(setting_name).items():
+    parts = lookup.split('__')
+    lookup_type = parts.pop() if len(parts) > 1 and parts[-1] in ('exact', 'in') else 'exact'
+    field = '__'.join(parts)
+
+    # 'organization_id', 'organization__id' and 'organization__pk' are the same field
+    for suffix in ('__id', '__pk', '_id'):
+      if field.endswith(suffix):
+        field = field[:-len(suffix)]
+
+    if field in ('pk', 'id'):
+      field = 'django_id'
+    elif field not in fields:
+      return None
+
+    values = list(value) if lookup_type == 'in' else [value]
+    if not values:
+      return None
+
+    lookup_q = SQ()
+    for v in values:
+      lookup_q.add(SQ(**{field: int(v) if isinstance(v, bool) else v}), SQ.OR)
+    q_obj.add(lookup_q, SQ.AND)
+
+  return q_obj
+
+
+def by_filter_out(queryset, setting_name, fields):
+  """ Remove unwanted results on the search engine, if exclusions can run there """
+  q_obj = get_filter_out_query(setting_name, fields)
+  if get_filter_out(setting_name) and q_obj is not None:
+    queryset = queryset.exclude(q_obj)
   return queryset
 
+
 def filter_out(queryset, setting_name):
   """
   Remove unwanted results from queryset
   """
-  kwargs = helpers.get_settings().get(setting_name, {}).get('FILTER_OUT', {})
+  kwargs = get_filter_out(setting_name)
   queryset = queryset.exclude(**kwargs)
   return queryset
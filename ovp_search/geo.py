@@ -0,0 +1,79 @@
+import math
+
+"""
+Radius search
+
+Projects and organizations index the coordinates of their address as
+latitude and longitude. Searches with lat, lng and radius(in km) filter
+the search engine by the bounding box of the circle, see
+filters.by_location, and the candidates it returns are then filtered by
+their exact distance to the center.
+"""
+
+EARTH_RADIUS = 6371.0
+MAX_RADIUS = 1000.0
+
+
+def get_location(params):
+  """ Returns (lat, lng, radius) from normalized params, or None """
+  try:
+    return tuple(float(params[name]) for name in ('lat', 'lng', 'radius'))
+  except KeyError:
+    return None
+
+
+def get_bounding_box(lat, lng, radius):
+  """
+  Returns (south, north, [(west, east), ...]) enclosing the circle
+
+  Boxes crossing the antimeridian are split in two longitude ranges,
+  boxes including a pole span every longitude.
+  """
+  angle = radius / EARTH_RADIUS
+  delta = math.degrees(angle)
+  south = max(lat - delta, -90.0)
+  north = min(lat + delta, 90.0)
+
+  if south == -90.0 or north == 90.0:
+    return south, north, [(-180.0, 180.0)]
+
+  delta = math.degrees(math.asin(math.sin(angle) / math.cos(math.radians(lat))))
+  west = lng - delta
+  east = lng + delta
+
+  if west < -180.0:
+    return south, north, [(west + 360.0, 180.0), (-180.0, east)]
+  if east > 180.0:
+    return south, north, [(west, 180.0), (-180.0, east - 360.0)]
+  return south, north, [(west, east)]
+
+
+def distance(lat1, lng1, lat2, lng2):
+  """ Great circle distance in km between two points """
+  lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+  a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+  return 2 * EARTH_RADIUS * math.asin(min(1.0, math.sqrt(a)))
+
+
+def within(queryset, location, order=False):
+  """
+  Returns primary keys on queryset within radius of the center
+
+  Primary keys keep the search engine ranking, or are sorted from the
+  nearest if order is set.
+  """
+  lat, lng, radius = location
+
+  results = []
+  for pk, latitude, longitude in queryset.values_list('pk', 'latitude', 'longitude'):
+    if latitude is None or longitude is None:
+      continue
+
+    d = distance(lat, lng, float(latitude), float(longitude))
+    if d <= radius:
+      results.append((d, len(results), int(pk)))
+
+  if order:
+    results.sort()
+
+  return [pk for d, position, pk in results]
@@ -1,14 +1,32 @@
 from django.conf import settings
+from django.utils.encoding import force_text
 from haystack import connection_router, connections
+from haystack.constants import DJANGO_CT
 from haystack.inputs import Raw
+from haystack.utils import get_model_ct
+from ovp_core.helpers import get_address_model
+from ovp_core.models import GoogleAddress, SimpleAddress
 
-def is_whoosh_backend():
-  backend_alias = connection_router.for_read()
+import warnings
 
-  return connections[backend_alias].__class__.__name__ == "WhooshEngine"
+# Maximum number of terms returned by a facet
+FACET_LIMIT = 10000
+
+def get_engine_name(using=None):
+  backend_alias = using or connection_router.for_read()
+
+  return connections[backend_alias].__class__.__name__
+
+
+def is_whoosh_backend(using=None):
+  # Also matches engines extending WhooshEngine, such as BufferedWhooshEngine
+  return get_engine_name(using).endswith("WhooshEngine")
 
 
 def whoosh_raw(t):
+  """ Deprecated, filter keyword fields through compiler.get_compiler instead """
+  warnings.warn("helpers.whoosh_raw is deprecated, use ovp_search.compiler.get_compiler().filter instead", DeprecationWarning, stacklevel=2)
+
   if is_whoosh_backend():
     return Raw("(\"{}\")".format(t))
 
@@ -19,12 +37,131 @@ def whoosh_raw(t):
 def get_settings(string="OVP_SEARCH"):
   return getattr(settings, string, {})
 
-def get_cities(queryset):
+# Regions searched as any of their countries
+REGION_ALIASES = {
+  'Caribbean': ('Jamaica', 'Haiti', 'Saint Lucia', 'Suriname', 'Trinidad & Tobago'),
+}
+
+def get_region_aliases():
+  """ Returns region aliases, OVP_SEARCH['REGION_ALIASES'] maps region names to country names """
+  return get_settings().get('REGION_ALIASES', REGION_ALIASES)
+
+def get_facet_fieldname(queryset, field):
+  return connections[queryset.query._using].get_unified_index().get_facet_fieldname(field)
+
+def facet(queryset, fields):
+  """
+  Request facet counts for fields along with the results
+
+  Whoosh is not supported by haystack faceting, so facet_counts groups
+  by the field natively instead.
+  """
+  using = queryset.query._using
+
+  if is_whoosh_backend(using):
+    return queryset
+
+  # whoosh is used on development/testing
+  # therefore we don't cover the following lines, as they're never called on a test environment
+  for field in fields: # pragma: no cover
+    if "Elasticsearch" in get_engine_name(using):
+      queryset = queryset.facet(field, size=FACET_LIMIT)
+    else:
+      queryset = queryset.facet(field, limit=FACET_LIMIT)
+
+  return queryset # pragma: no cover
+
+def facet_counts(queryset, fields):
+  """
+  Returns a dict with term counts for each faceted field
+
+  If the queryset has already run, engines that support faceting return
+  the counts from the same query as the results.
+  """
+  using = queryset.query._using
+
+  if is_whoosh_backend(using):
+    return {field: whoosh_facet_counts(queryset, get_facet_fieldname(queryset, field)) for field in fields}
+
+  # whoosh is used on development/testing
+  # therefore we don't cover the following lines, as they're never called on a test environment
+  counts = queryset.facet_counts().get('fields', {}) # pragma: no cover
+  return {field: dict(counts.get(get_facet_fieldname(queryset, field), [])) for field in fields} # pragma: no cover
+
+def get_facet_counts(queryset, field):
+  """ Returns a dict with term counts for a faceted field in a single query """
+  return facet_counts(facet(queryset, [field]), [field])[field]
+
+def whoosh_facet_counts(queryset, facet_fieldname):
+  from whoosh import sorting
+  from whoosh.query import And
+
+  backend = connections[queryset.query._using].get_backend()
+  if not backend.setup_complete:
+    backend.setup()
+  backend.index = backend.index.refresh()
+
+  narrow_queries = set(queryset.query.narrow_queries)
+  if queryset.query.models:
+    narrow_queries.add(' OR '.join(['%s:%s' % (DJANGO_CT, get_model_ct(model)) for model in queryset.query.models]))
+
+  query = backend.parser.parse(force_text(queryset.query.build_query()))
+  narrow = [backend.parser.parse(force_text(nq)) for nq in narrow_queries]
+  facet = sorting.FieldFacet(facet_fieldname, allow_overlap=True, maptype=sorting.Count)
+
+  searcher = backend.index.searcher()
+  try:
+    results = searcher.search(query, filter=And(narrow) if narrow else None, limit=None, groupedby=facet)
+    # Documents without a value on the field are grouped under None
+    return {term: count for term, count in results.groups(facet_fieldname).items() if term}
+  finally:
+    searcher.close()
+
+def get_address_prefetch(field='address'):
+  """ Returns prefetch_related lookups used by get_address_components """
+  if get_address_model() == GoogleAddress:
+    return ['{}__address_components__types'.format(field)]
+  return []
+
+def get_address_components(address):
+  """ Returns a list of "long_name-type" strings for an address """
+  types = []
+
+  if address:
+    if type(address) == GoogleAddress:
+      for component in address.address_components.all():
+        for component_type in component.types.all():
+          types.append(u'{}-{}'.format(component.long_name, component_type.name))
+
+    if type(address) == SimpleAddress:
+      if address.city:
+        types.append(u'{}-{}'.format(address.city, 'locality'))
+      if address.country:
+        types.append(u'{}-{}'.format(address.country, 'country'))
+
+  return types
+
+def get_coordinates(address):
+  """
+  Returns (lat, lng) of an address, or (None, None)
+
+  Geocoding updates coordinates on the database after the address is
+  saved, so they are read from there if the instance doesn't have them.
+  """
+  if type(address) != GoogleAddress:
+    return None, None
+
+  if (address.lat is None or address.lng is None) and address.pk:
+    return GoogleAddress.objects.filter(pk=address.pk).values_list('lat', 'lng').first() or (None, None)
+
+  return address.lat, address.lng
+
+def get_cities(counts):
+  """ Returns city names from address_components facet counts """
   cities = set()
-  for item in queryset:
-    for comp in item.address_components:
-      if "-administrative_area_level_2" in comp or "-locality" in comp:
-        city_name = comp.replace("-administrative_area_level_2", "").replace("-locality", "")
-        cities.add(city_name)
+  for comp, count in counts.items():
+    if count and ("-administrative_area_level_2" in comp or "-locality" in comp):
+      city_name = comp.replace("-administrative_area_level_2", "").replace("-locality", "")
+      cities.add(city_name)
 
   return cities
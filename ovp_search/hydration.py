@@ -0,0 +1,178 @@
+from django.db import connections
+from django.db.models import Case, When, Value, IntegerField, Q
+from django.db.models.expressions import RawSQL
+from django.db.models.sql.constants import INNER, LOUTER
+
+from ovp_search import helpers
+
+"""
+Hydration turns primary keys returned by the search engine into model
+instances, keeping the order the engine returned them in.
+
+Small lists are filtered with a plain IN, with a parameter per primary
+key. Lists longer than OVP_SEARCH['HYDRATION_IN_LIMIT'] are passed as a
+single array on PostgreSQL and joined as a VALUES list of (primary key,
+position) rows on SQLite, which avoids SQLite's parameter limit and
+orders by the joined position instead of a CASE over every key. Other
+databases fetch them in chunks of IN queries, merged in order. Use the
+benchmark_hydration command to find the limit for a database.
+"""
+
+IN_LIMIT = 500
+
+IN = 'in'
+ARRAY = 'array'
+VALUES = 'values'
+CHUNKED = 'chunked'
+
+
+def get_in_limit():
+  return int(helpers.get_settings().get('HYDRATION_IN_LIMIT', IN_LIMIT))
+
+
+def get_strategies(queryset):
+  """ Returns strategies supported by the database queryset runs on """
+  vendor = connections[queryset.db].vendor
+  if vendor == 'postgresql':
+    return [IN, ARRAY, VALUES] # pragma: no cover
+  if vendor == 'sqlite':
+    return [IN, VALUES]
+  return [IN, CHUNKED] # pragma: no cover
+
+
+def get_strategy(queryset, size):
+  if size <= get_in_limit():
+    return IN
+  return get_strategies(queryset)[1]
+
+
+def get_pk_column(queryset):
+  quote_name = connections[queryset.db].ops.quote_name
+  meta = queryset.model._meta
+  return '{}.{}'.format(quote_name(meta.db_table), quote_name(meta.pk.column))
+
+
+class ValuesJoin(object):
+  """
+  Joins (primary key, position) rows listed as VALUES on the primary key
+
+  Entries on Query.alias_map only need to be Join compatible, so the list
+  is composed, cloned and counted along with the rest of the queryset.
+
+  Rows are inlined instead of passed as parameters, which would hit the
+  parameter limits this strategy avoids. They are safe to inline, as
+  primary keys are coerced to int before they get here.
+  """
+  table_name = 'search_pks'
+  nullable = False
+
+  def __init__(self, parent_alias, pk_column, pks, table_alias=None, join_type=INNER):
+    self.parent_alias = parent_alias
+    self.pk_column = pk_column
+    self.pks = pks
+    self.table_alias = table_alias
+    self.join_type = join_type
+
+  def get_rows_sql(self, connection):
+    """ Rows as a derived table with pk and position columns """
+    rows = ', '.join('({:d}, {:d})'.format(pk, i) for i, pk in enumerate(self.pks))
+    if connection.vendor == 'postgresql':
+      return '(VALUES {}) {} (pk, position)'.format(rows, self.table_alias) # pragma: no cover
+
+    # SQLite can't name derived table columns, VALUES columns are named column1, column2...
+    return '(SELECT column1 AS pk, column2 AS position FROM (VALUES {})) {}'.format(rows, self.table_alias)
+
+  def as_sql(self, compiler, connection):
+    pk_column = '{}.{}'.format(compiler.quote_name_unless_alias(self.parent_alias), connection.ops.quote_name(self.pk_column))
+    return '{} {} ON ({}.pk = {})'.format(self.join_type, self.get_rows_sql(connection), self.table_alias, pk_column), []
+
+  def relabeled_clone(self, change_map):
+    return self.__class__(change_map.get(self.parent_alias, self.parent_alias), self.pk_column, self.pks,
+                          change_map.get(self.table_alias, self.table_alias), self.join_type)
+
+  def demote(self):
+    return self.__class__(self.parent_alias, self.pk_column, self.pks, self.table_alias, INNER)
+
+  def promote(self):
+    return self.__class__(self.parent_alias, self.pk_column, self.pks, self.table_alias, LOUTER)
+
+
+def join_pks(queryset, pks):
+  """ Returns queryset joined to pks, and the column holding their position """
+  queryset = queryset.all()
+  query = queryset.query
+  alias = query.join(ValuesJoin(query.get_initial_alias(), queryset.model._meta.pk.column, pks))
+  return queryset, '{}.position'.format(alias)
+
+
+def get_chunks(pks):
+  limit = max(get_in_limit(), 1)
+  return [pks[i:i + limit] for i in range(0, len(pks), limit)]
+
+
+def filter_pks(queryset, pks, strategy=None):
+  """ Filter queryset by a list of integer primary keys """
+  pks = [int(pk) for pk in pks]
+  strategy = strategy or get_strategy(queryset, len(pks))
+
+  if strategy == IN or not pks:
+    return queryset.filter(pk__in=pks)
+
+  if strategy == ARRAY: # pragma: no cover
+    return queryset.extra(where=['{} = ANY(%s)'.format(get_pk_column(queryset))], params=[pks])
+
+  if strategy == CHUNKED:
+    q_obj = Q()
+    for chunk in get_chunks(pks):
+      q_obj |= Q(pk__in=chunk)
+    return queryset.filter(q_obj)
+
+  return join_pks(queryset, pks)[0]
+
+
+def order_by_position(queryset, pks, strategy=None):
+  """
+  Order queryset by the position of each primary key in pks
+
+  The VALUES strategy also filters queryset by pks, as positions come
+  from the joined list.
+  """
+  pks = [int(pk) for pk in pks]
+  strategy = strategy or get_strategy(queryset, len(pks))
+
+  if strategy in (IN, CHUNKED) or not pks:
+    whens = [When(pk=pk, then=Value(i)) for i, pk in enumerate(pks)]
+    position = Case(*whens, default=Value(len(pks)), output_field=IntegerField())
+  elif strategy == ARRAY: # pragma: no cover
+    position = RawSQL('array_position(%s::integer[], {})'.format(get_pk_column(queryset)), (pks,), output_field=IntegerField())
+  else:
+    queryset, column = join_pks(queryset, pks)
+    position = RawSQL(column, (), output_field=IntegerField())
+
+  return queryset.annotate(search_position=position).order_by('search_position')
+
+
+def hydrate_chunks(queryset, pks):
+  """ Returns a list of objects for pks, fetched in chunks of IN queries """
+  objects = {}
+  for chunk in get_chunks(pks):
+    objects.update((obj.pk, obj) for obj in queryset.filter(pk__in=chunk))
+
+  return [objects[pk] for pk in pks if pk in objects]
+
+
+def hydrate(queryset, pks, strategy=None):
+  """
+  Returns objects for pks, in the same order
+
+  Objects are returned as a queryset, or as a list with the CHUNKED
+  strategy.
+  """
+  pks = [int(pk) for pk in pks]
+  strategy = strategy or get_strategy(queryset, len(pks))
+
+  if strategy == CHUNKED:
+    return hydrate_chunks(queryset, pks)
+  if strategy == VALUES and pks:
+    return order_by_position(queryset, pks, strategy)
+  return order_by_position(filter_pks(queryset, pks, strategy), pks, strategy)
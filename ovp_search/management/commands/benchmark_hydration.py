@@ -0,0 +1,64 @@
+from django.core.management.base import BaseCommand
+from django.db.models import Max
+
+from ovp_projects.models import Project
+
+from ovp_search import hydration
+
+import time
+
+
+class Command(BaseCommand):
+  help = "Time hydration strategies for growing primary key lists, to choose OVP_SEARCH['HYDRATION_IN_LIMIT']"
+
+  def add_arguments(self, parser):
+    parser.add_argument('--sizes', default='100,250,500,1000,2500,5000,10000,25000', help="Comma delimited list sizes")
+    parser.add_argument('--repeat', type=int, default=5, help="Runs per size and strategy, the best is reported")
+
+  def handle(self, *args, **options):
+    queryset = Project.objects.all()
+    sizes = [int(size) for size in options['sizes'].split(',')]
+    strategies = hydration.get_strategies(queryset)
+
+    self.stdout.write("{:>8} {}".format('size', ' '.join('{:>10}'.format(s) for s in strategies)))
+
+    crossover = None
+    for size in sizes:
+      pks = self.get_pks(queryset, size)
+      timings = [self.time(queryset, pks, strategy, options['repeat']) for strategy in strategies]
+      self.stdout.write("{:>8} {}".format(size, ' '.join(self.format_time(t) for t in timings)))
+
+      # Strategies the database failed to run are ignored
+      finished = [(t, i) for i, t in enumerate(timings) if t is not None]
+      if crossover is None and finished and min(finished)[1] != 0:
+        crossover = size
+
+    if crossover:
+      self.stdout.write("IN is slower from {} primary keys".format(crossover))
+    else:
+      self.stdout.write("IN was the fastest for every size")
+
+  def get_pks(self, queryset, size):
+    """ Existing primary keys, completed with keys past the last one """
+    pks = list(queryset.order_by('?').values_list('pk', flat=True)[:size])
+    last = queryset.aggregate(last=Max('pk'))['last'] or 0
+    return pks + list(range(last + 1, last + 1 + size - len(pks)))
+
+  def time(self, queryset, pks, strategy, repeat):
+    """ Best time in seconds to hydrate pks, None if the database can't run it """
+    best = None
+    for i in range(repeat):
+      started = time.time()
+      try:
+        list(hydration.hydrate(queryset, pks, strategy))
+      except Exception: # pragma: no cover
+        return None
+      elapsed = time.time() - started
+      best = elapsed if best is None else min(best, elapsed)
+
+    return best
+
+  def format_time(self, seconds):
+    if seconds is None:
+      return '{:>10}'.format('failed') # pragma: no cover
+    return '{:>8.1f}ms'.format(seconds * 1000)
@@ -0,0 +1,25 @@
+from django.core.management.base import BaseCommand
+
+from ovp_search import search_queue
+
+import time
+
+
+class Command(BaseCommand):
+  help = "Write pending index operations queued by TiedModelQueuedSignalProcessor"
+
+  def add_arguments(self, parser):
+    parser.add_argument('--batch-size', type=int, default=search_queue.BATCH_SIZE, help="Number of entries processed at once")
+    parser.add_argument('--max-attempts', type=int, default=search_queue.MAX_ATTEMPTS, help="Entries failing this many times are not retried")
+    parser.add_argument('--sleep', type=int, default=0, help="Keep polling the queue, waiting this many seconds when it is empty")
+
+  def handle(self, *args, **options):
+    while True:
+      processed, failed = search_queue.process(options['batch_size'], options['max_attempts'])
+
+      if options['verbosity'] and (processed or failed or not options['sleep']):
+        self.stdout.write("Processed {} entries, {} failed".format(processed, failed))
+
+      if not options['sleep']:
+        return
+      time.sleep(options['sleep'])
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from ovp_search import cities
+
+
+class Command(BaseCommand):
+  help = "Rebuild available cities per country from scratch"
+
+  def handle(self, *args, **options):
+    count = cities.rebuild()
+
+    if options['verbosity']:
+      self.stdout.write("Rebuilt {} country cities".format(count))
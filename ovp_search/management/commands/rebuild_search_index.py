@@ -0,0 +1,28 @@
+from django.core.management.base import BaseCommand
+from haystack import connections
+
+from ovp_search import rebuild
+
+import multiprocessing
+
+
+class Command(BaseCommand):
+  help = "Clear and rebuild search indexes using multiple processes"
+
+  def add_arguments(self, parser):
+    parser.add_argument('--using', action='append', default=[], help="Rebuild only the named connection, can be used multiple times")
+    parser.add_argument('--workers', type=int, default=multiprocessing.cpu_count(), help="Number of worker processes, 0 runs on the current process")
+    parser.add_argument('--batch-size', type=int, default=rebuild.BATCH_SIZE, help="Number of objects prepared by a worker at once")
+
+  def handle(self, *args, **options):
+    for using in options['using'] or connections.connections_info.keys():
+      stats, seconds = rebuild.rebuild(using, options['workers'], options['batch_size'])
+
+      if options['verbosity']:
+        for model, count, model_seconds in stats:
+          self.stdout.write(self.format_rate(using, model.__name__, count, model_seconds))
+        self.stdout.write(self.format_rate(using, 'Total', sum(s[1] for s in stats), seconds))
+
+  def format_rate(self, using, name, count, seconds):
+    rate = count / seconds if seconds else 0
+    return "{} {}: {} docs in {:.2f}s ({:.0f} docs/sec)".format(using, name, count, seconds, rate)
@@ -0,0 +1,21 @@
+from django.core.management.base import BaseCommand
+from haystack import connections
+
+from ovp_search import watermarks
+
+
+class Command(BaseCommand):
+  help = "Reindex objects modified since the last run"
+
+  def add_arguments(self, parser):
+    parser.add_argument('--using', action='append', default=[], help="Update only the named connection, can be used multiple times")
+    parser.add_argument('--batch-size', type=int, default=watermarks.BATCH_SIZE, help="Number of objects indexed at once")
+    parser.add_argument('--reset', action='store_true', default=False, help="Reindex everything, ignoring watermarks")
+
+  def handle(self, *args, **options):
+    for using in options['using'] or connections.connections_info.keys():
+      for model in connections[using].get_unified_index().get_indexed_models():
+        updated, removed = watermarks.update(using, model, options['batch_size'], options['reset'])
+
+        if options['verbosity']:
+          self.stdout.write("{} {}: updated {}, removed {}".format(using, model.__name__, updated, removed))
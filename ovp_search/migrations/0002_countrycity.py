@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.5 on 2026-10-17 12:00
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ovp_search', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CountryCity',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('country', models.CharField(db_index=True, max_length=400, verbose_name='Country')),
+                ('city', models.CharField(max_length=400, verbose_name='City')),
+                ('projects', models.PositiveIntegerField(default=0, verbose_name='Projects')),
+                ('organizations', models.PositiveIntegerField(default=0, verbose_name='Organizations')),
+            ],
+            options={
+                'verbose_name': 'country city',
+                'verbose_name_plural': 'country cities',
+            },
+        ),
+        migrations.CreateModel(
+            name='CountryCityReference',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('kind', models.CharField(max_length=20, verbose_name='Kind')),
+                ('object_id', models.PositiveIntegerField(verbose_name='Object id')),
+                ('country_city', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='references', to='ovp_search.CountryCity', verbose_name='country city')),
+            ],
+        ),
+        migrations.AlterUniqueTogether(
+            name='countrycity',
+            unique_together=set([('country', 'city')]),
+        ),
+        migrations.AlterUniqueTogether(
+            name='countrycityreference',
+            unique_together=set([('kind', 'object_id', 'country_city')]),
+        ),
+    ]
@@ -0,0 +1,33 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.5 on 2026-10-17 12:00
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ovp_search', '0002_countrycity'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IndexQueueEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('model', models.CharField(max_length=100, verbose_name='Model')),
+                ('object_id', models.PositiveIntegerField(verbose_name='Object id')),
+                ('action', models.CharField(choices=[('update', 'Update'), ('remove', 'Remove')], max_length=10, verbose_name='Action')),
+                ('attempts', models.PositiveSmallIntegerField(default=0, verbose_name='Attempts')),
+                ('available_date', models.DateTimeField(db_index=True, default=django.utils.timezone.now, verbose_name='Available date')),
+                ('last_error', models.TextField(blank=True, default='', verbose_name='Last error')),
+                ('created_date', models.DateTimeField(auto_now_add=True, verbose_name='Created date')),
+            ],
+            options={
+                'verbose_name': 'index queue entry',
+                'verbose_name_plural': 'index queue entries',
+            },
+        ),
+    ]
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.5 on 2026-10-17 12:00
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ovp_search', '0003_indexqueueentry'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='IndexWatermark',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('using', models.CharField(max_length=100, verbose_name='Connection')),
+                ('model', models.CharField(max_length=100, verbose_name='Model')),
+                ('updated_date', models.DateTimeField(verbose_name='Updated date')),
+            ],
+            options={
+                'verbose_name': 'index watermark',
+                'verbose_name_plural': 'index watermarks',
+            },
+        ),
+        migrations.AlterUniqueTogether(
+            name='indexwatermark',
+            unique_together=set([('using', 'model')]),
+        ),
+    ]
@@ -0,0 +1,20 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.10.5 on 2026-10-17 12:00
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('ovp_search', '0004_indexwatermark'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='indexqueueentry',
+            name='claim',
+            field=models.CharField(blank=True, db_index=True, default='', max_length=32, verbose_name='Claim'),
+        ),
+    ]
@@ -0,0 +1,3 @@
+from ovp_search.models.cities import CountryCity, CountryCityReference
+from ovp_search.models.queue import IndexQueueEntry
+from ovp_search.models.watermark import IndexWatermark
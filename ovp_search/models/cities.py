@@ -0,0 +1,37 @@
+from django.db import models
+from django.utils.translation import ugettext_lazy as _
+
+
+class CountryCity(models.Model):
+  """
+  Number of listed projects and organizations on a city
+
+  Maintained incrementally by TiedModelRealtimeSignalProcessor. Can be
+  rebuilt with the rebuild_available_cities command.
+  """
+  country = models.CharField(_('Country'), max_length=400, db_index=True)
+  city = models.CharField(_('City'), max_length=400)
+  projects = models.PositiveIntegerField(_('Projects'), default=0)
+  organizations = models.PositiveIntegerField(_('Organizations'), default=0)
+
+  def __str__(self):
+    return '{}, {}'.format(self.city, self.country)
+
+  class Meta:
+    app_label = 'ovp_search'
+    unique_together = ('country', 'city')
+    verbose_name = _('country city')
+    verbose_name_plural = _('country cities')
+
+
+class CountryCityReference(models.Model):
+  """
+  A project or organization counted on a CountryCity
+  """
+  country_city = models.ForeignKey(CountryCity, models.CASCADE, related_name='references', verbose_name=_('country city'))
+  kind = models.CharField(_('Kind'), max_length=20)
+  object_id = models.PositiveIntegerField(_('Object id'))
+
+  class Meta:
+    app_label = 'ovp_search'
+    unique_together = ('kind', 'object_id', 'country_city')
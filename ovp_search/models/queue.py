@@ -0,0 +1,37 @@
+from django.db import models
+from django.utils import timezone
+from django.utils.translation import ugettext_lazy as _
+
+
+class IndexQueueEntry(models.Model):
+  """
+  A pending index operation for an object
+
+  Inserted by TiedModelQueuedSignalProcessor and processed by the
+  process_search_queue command. Entries for the same object are coalesced
+  when processed. Workers claim entries before processing them, see
+  search_queue.claim_pending.
+  """
+  UPDATE = 'update'
+  REMOVE = 'remove'
+  ACTIONS = (
+    (UPDATE, _('Update')),
+    (REMOVE, _('Remove')),
+  )
+
+  model = models.CharField(_('Model'), max_length=100)
+  object_id = models.PositiveIntegerField(_('Object id'))
+  action = models.CharField(_('Action'), max_length=10, choices=ACTIONS)
+  attempts = models.PositiveSmallIntegerField(_('Attempts'), default=0)
+  available_date = models.DateTimeField(_('Available date'), default=timezone.now, db_index=True)
+  last_error = models.TextField(_('Last error'), blank=True, default='')
+  claim = models.CharField(_('Claim'), max_length=32, blank=True, default='', db_index=True)
+  created_date = models.DateTimeField(_('Created date'), auto_now_add=True)
+
+  def __str__(self):
+    return '{} {}.{}'.format(self.action, self.model, self.object_id)
+
+  class Meta:
+    app_label = 'ovp_search'
+    verbose_name = _('index queue entry')
+    verbose_name_plural = _('index queue entries')
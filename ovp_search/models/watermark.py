@@ -0,0 +1,22 @@
+from django.db import models
+from django.utils.translation import ugettext_lazy as _
+
+
+class IndexWatermark(models.Model):
+  """
+  When an index was last updated by the update_search_index command
+
+  Only objects modified after the watermark are reindexed on the next run.
+  """
+  using = models.CharField(_('Connection'), max_length=100)
+  model = models.CharField(_('Model'), max_length=100)
+  updated_date = models.DateTimeField(_('Updated date'))
+
+  def __str__(self):
+    return '{} {}'.format(self.using, self.model)
+
+  class Meta:
+    app_label = 'ovp_search'
+    unique_together = ('using', 'model')
+    verbose_name = _('index watermark')
+    verbose_name_plural = _('index watermarks')
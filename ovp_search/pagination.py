@@ -0,0 +1,222 @@
+from ovp_search import helpers
+from ovp_search import result_cache
+
+from rest_framework import pagination
+from rest_framework.exceptions import NotFound
+from rest_framework.response import Response
+from rest_framework.utils.urls import remove_query_param, replace_query_param
+
+from haystack.query import SearchQuerySet
+
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import OrderedDict
+import binascii
+import hashlib
+
+
+class SearchResults(object):
+  """
+  Lazy list of primary keys for a SearchQuerySet
+
+  Slices are fetched from the search engine, which also returns the
+  hit count and requested facet counts, so a page costs a single engine
+  query. Each fetched window is cached together with these counts.
+
+  If payloads is True, stored payloads are fetched along with the keys
+  and kept on the payloads dict.
+
+  Windows should start at a multiple of their size: Whoosh fetches
+  slices as pages, from int(start / size) * size.
+  """
+  def __init__(self, queryset, key, facets=None, payloads=False):
+    self.facets = facets or []
+    self.use_payloads = payloads
+    fields = ('pk', 'payload') if payloads else ('pk',)
+    self.queryset = helpers.facet(queryset, self.facets).values_list(*fields)
+    self.key = key
+    self._window = None
+    self._pks = []
+    self._count = None
+    self.facet_counts = None
+    self.payloads = None
+
+  def fetch(self, start, stop):
+    cached = result_cache.get_page(self.key, start, stop)
+
+    # Windows cached without payloads can't serve them
+    if cached is not None and self.use_payloads and cached[3] is None:
+      cached = None
+
+    if cached is None:
+      rows = list(self.queryset[start:stop])
+      pks = [int(row[0]) for row in rows]
+      payloads = [row[1] for row in rows] if self.use_payloads else None
+      count = self.queryset.count()
+      facet_counts = helpers.facet_counts(self.queryset, self.facets) if self.facets else None
+      result_cache.set_page(self.key, start, stop, count, pks, facet_counts, payloads)
+    else:
+      count, pks, facet_counts, payloads = cached
+
+    self._window = (start, stop)
+    self._pks = pks
+    self._count = count
+    self.facet_counts = facet_counts
+    self.payloads = dict(zip(pks, payloads)) if self.use_payloads else None
+
+  def count(self):
+    if self._count is None:
+      self.fetch(0, 0)
+    return self._count
+
+  def __len__(self):
+    return self.count()
+
+  def __getitem__(self, index):
+    if not isinstance(index, slice):
+      return self[index:index + 1][0]
+
+    start = index.start or 0
+    stop = index.stop if index.stop is not None else self.count()
+
+    if self._window is None or start < self._window[0] or stop > self._window[1]:
+      self.fetch(start, stop)
+
+    offset = self._window[0]
+    return self._pks[start - offset:stop - offset]
+
+
+class DefaultSearchPagination(pagination.PageNumberPagination):
+  page_size = 20
+  page_size_query_param = 'page_size'
+  max_page_size = 30
+
+
+class SearchQuerySetPagination(DefaultSearchPagination):
+  """
+  Paginates SearchQuerySets on the search engine
+
+  Only the primary keys for the requested page are fetched and then
+  hydrated through view.hydrate. Database querysets are paginated as usual.
+
+  Pages are rendered through view.render_page, along with the payloads
+  stored on the index if view.use_payloads returns True.
+
+  Facet counts requested through view.get_facets are added to the response.
+
+  Requests with the cursor parameter are paginated by cursor instead. An
+  empty cursor starts from the first result. Cursors encode the engine
+  offset of the next page and a hash of the canonical query, so a page
+  costs one bounded engine query, which also returns the hit count used
+  to tell if there's a next page. Facets are not counted.
+  """
+  facet_counts = None
+  cursor_query_param = 'cursor'
+  invalid_cursor_message = 'Invalid cursor'
+  cursor = None
+
+  def get_page_window(self, request, page_size):
+    try:
+      page_number = int(request.query_params.get(self.page_query_param, 1))
+    except ValueError:
+      page_number = 1
+
+    start = (max(page_number, 1) - 1) * page_size
+    return start, start + page_size
+
+  def get_query_hash(self, view):
+    return hashlib.sha1(view.get_cache_key().encode('utf-8')).hexdigest()[:16]
+
+  def encode_cursor(self, offset, query_hash):
+    cursor = '{}:{}'.format(offset, query_hash).encode('ascii')
+    return urlsafe_b64encode(cursor).decode('ascii').rstrip('=')
+
+  def decode_cursor(self, cursor, query_hash):
+    """ Returns the offset encoded on cursor, for the query with query_hash """
+    if not cursor:
+      return 0
+
+    try:
+      cursor = urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4)).decode('ascii')
+      offset, cursor_hash = cursor.split(':')
+      offset = int(offset)
+    except (TypeError, ValueError, binascii.Error):
+      raise NotFound(self.invalid_cursor_message)
+
+    # Cursors are only valid for the query they were created for
+    if offset < 0 or cursor_hash != query_hash:
+      raise NotFound(self.invalid_cursor_message)
+
+    return offset
+
+  def paginate_by_cursor(self, queryset, request, view):
+    page_size = self.get_page_size(request)
+    query_hash = self.get_query_hash(view)
+    offset = self.decode_cursor(request.query_params[self.cursor_query_param], query_hash)
+
+    if isinstance(queryset, SearchQuerySet):
+      # Engine windows must be page aligned, cursors created with another
+      # page_size restart at the page containing their offset
+      offset -= offset % page_size
+
+    self.request = request
+    self.cursor = {'offset': offset, 'page_size': page_size, 'hash': query_hash, 'has_next': False}
+
+    stop = offset + page_size
+    if isinstance(queryset, SearchQuerySet):
+      results = SearchResults(queryset, view.get_cache_key(), payloads=view.use_payloads())
+      results.fetch(offset, stop)
+      pks = results[offset:stop]
+
+      self.cursor['has_next'] = stop < results.count()
+      stored = [results.payloads.get(pk) for pk in pks] if results.payloads is not None else None
+      return view.render_page(pks, stored)
+
+    # One result past the page tells if there's a next page
+    objects = list(queryset[offset:stop + 1])
+    self.cursor['has_next'] = len(objects) > page_size
+    return objects[:page_size]
+
+  def get_cursor_link(self, offset):
+    url = remove_query_param(self.request.build_absolute_uri(), self.page_query_param)
+    return replace_query_param(url, self.cursor_query_param, self.encode_cursor(offset, self.cursor['hash']))
+
+  def get_cursor_paginated_response(self, data):
+    offset, page_size = self.cursor['offset'], self.cursor['page_size']
+    next_link = self.get_cursor_link(offset + page_size) if self.cursor['has_next'] else None
+    previous_link = self.get_cursor_link(max(offset - page_size, 0)) if offset else None
+
+    return Response(OrderedDict([
+      ('next', next_link),
+      ('previous', previous_link),
+      ('results', data),
+    ]))
+
+  def paginate_queryset(self, queryset, request, view=None):
+    if self.cursor_query_param in request.query_params:
+      return self.paginate_by_cursor(queryset, request, view)
+
+    if not isinstance(queryset, SearchQuerySet):
+      self.facet_counts = getattr(view, 'facet_counts', None)
+      return super(SearchQuerySetPagination, self).paginate_queryset(queryset, request, view)
+
+    page_size = self.get_page_size(request)
+    if not page_size: # pragma: no cover
+      return None
+
+    # Fetch the page and the hit count before the paginator asks for them
+    results = SearchResults(queryset, view.get_cache_key(), view.get_facets(), view.use_payloads())
+    results.fetch(*self.get_page_window(request, page_size))
+    self.facet_counts = results.facet_counts
+
+    pks = super(SearchQuerySetPagination, self).paginate_queryset(results, request, view)
+    stored = [results.payloads.get(pk) for pk in pks] if results.payloads is not None else None
+    return view.render_page(pks, stored)
+
+  def get_paginated_response(self, data):
+    if self.cursor is not None:
+      return self.get_cursor_paginated_response(data)
+
+    response = super(SearchQuerySetPagination, self).get_paginated_response(data)
+    if self.facet_counts is not None:
+      response.data['facets'] = self.facet_counts
+    return response
@@ -0,0 +1,76 @@
+from django.contrib.auth.models import AnonymousUser
+from rest_framework import serializers
+from rest_framework.utils.encoders import JSONEncoder
+
+from ovp_search import helpers
+
+import json
+
+"""
+Index-only responses
+
+When OVP_SEARCH['INDEX_PAYLOADS'] is enabled, indexes store the search
+serializer representation of each object and search resources respond
+with it, without querying the database.
+
+Payloads are rendered for an anonymous user with host relative urls.
+Urls are made absolute for the current request. Payloads only change when
+the object is reindexed, so changes to related objects such as the
+organization or owner name show up after update_search_index.
+"""
+
+
+def is_enabled():
+  return bool(helpers.get_settings().get('INDEX_PAYLOADS', False))
+
+
+class PayloadRequest(object):
+  """ Stands in for the request while rendering payloads on index time """
+  user = AnonymousUser()
+
+  def build_absolute_uri(self, location=None):
+    return location
+
+
+def render(serializer_class, obj):
+  """ Returns the serialized representation of obj as JSON """
+  data = serializer_class(obj, context={'request': PayloadRequest()}).data
+  return json.dumps(data, cls=JSONEncoder)
+
+
+def load(payload):
+  """ Returns a stored payload as a dict, or None if there's no usable payload """
+  if isinstance(payload, dict):
+    return payload
+
+  try:
+    payload = json.loads(payload)
+  except (TypeError, ValueError):
+    return None
+
+  return payload if isinstance(payload, dict) else None
+
+
+def absolutize(data, request):
+  """ Make host relative urls on a payload absolute for request """
+  if isinstance(data, dict):
+    for key, value in data.items():
+      if key.endswith('_url') and isinstance(value, str) and value.startswith('/'):
+        data[key] = request.build_absolute_uri(value)
+      else:
+        absolutize(value, request)
+  elif isinstance(data, list):
+    for value in data:
+      absolutize(value, request)
+
+  return data
+
+
+class PayloadList(list):
+  """ A page of representations built from payloads """
+
+
+class PayloadSerializer(serializers.BaseSerializer):
+  """ Returns representations in a PayloadList as they are """
+  def to_representation(self, instance):
+    return instance
@@ -0,0 +1,234 @@
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+from haystack.query import SQ
+
+from ovp_search import helpers
+from ovp_search import geo
+
+import datetime
+import hashlib
+import json
+import math
+
+DATETIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+
+###########################
+## Parameter normalizers ##
+###########################
+
+def normalize_text(string=None):
+  """ Collapse whitespace on free text parameters """
+  if string:
+    string = ' '.join(string.split())
+  return string or None
+
+
+def normalize_boolean(string=None):
+  """ Only 'true' enables a boolean parameter """
+  return 'true' if string == 'true' else None
+
+
+def normalize_published(string='true'):
+  """ Published defaults to 'true', anything other than 'true' or 'false' means both """
+  if string is None:
+    string = 'true'
+  if string in ('true', 'false'):
+    return string
+  return 'both'
+
+
+def sort_items(items):
+  """ Dedupe and sort items, numeric ids are sorted numerically """
+  items = set(i.strip() for i in items if len(i.strip()) > 0)
+  return sorted(items, key=lambda i: (0, int(i), i) if i.isdigit() else (1, 0, i))
+
+
+def normalize_list(string=None):
+  """
+  Normalize a comma delimited list with an optional operator prefix
+
+  'cause=3,1', 'cause=1,3,3' and 'cause=OR,1,3' all become 'OR,1,3'
+  """
+  if not string:
+    return None
+
+  items = string.split(',')
+  operator = SQ.OR
+  if items[0] in (SQ.AND, SQ.OR):
+    operator = items.pop(0)
+
+  items = sort_items(items)
+  if not items:
+    return None
+
+  return ','.join([operator] + items)
+
+
+def normalize_id_list(string=None):
+  """ Normalize a comma delimited list of ids without operator """
+  if not string:
+    return None
+
+  items = sort_items(string.split(','))
+  return ','.join(items) or None
+
+
+def normalize_address(string=None):
+  """
+  Normalize the address JSON to the parts used by filters.by_address
+
+  Components are joined with AND, so their order is not relevant. Types
+  inside a component are joined with OR, so they are deduped and sorted.
+  Invalid JSON is kept as is, so filtering still fails loudly.
+  """
+  if not string:
+    return None
+
+  try:
+    address = json.loads(string)
+  except ValueError:
+    return string
+
+  if not isinstance(address, dict) or u'address_components' not in address:
+    return None
+
+  components = []
+  for component in address[u'address_components']:
+    components.append({
+      u'long_name': component[u'long_name'],
+      u'types': sorted(set(component[u'types'])),
+    })
+
+  if len(components) and components[0][u'long_name'] in helpers.get_region_aliases():
+    # Region filters ignore any other component
+    components = components[:1]
+  else:
+    components = sorted(components, key=lambda c: (c[u'long_name'], c[u'types']))
+
+  return json.dumps({u'address_components': components}, sort_keys=True, separators=(',', ':'))
+
+
+def normalize_datetime(string=None):
+  """
+  Normalize an ISO 8601 date or datetime to UTC
+
+  Naive values are on the current timezone, dates start at midnight.
+  Invalid values are ignored.
+  """
+  if not string:
+    return None
+
+  try:
+    value = parse_datetime(string) or parse_date(string)
+  except ValueError:
+    return None
+
+  if value is None:
+    return None
+
+  if not isinstance(value, datetime.datetime):
+    value = datetime.datetime(value.year, value.month, value.day)
+  if timezone.is_naive(value):
+    value = timezone.make_aware(value)
+
+  return value.astimezone(timezone.utc).strftime(DATETIME_FORMAT)
+
+
+def normalize_number(string, minimum, maximum):
+  """ Normalize a number within [minimum, maximum], invalid values are ignored """
+  try:
+    value = float(string)
+  except (TypeError, ValueError):
+    return None
+
+  if math.isnan(value) or value < minimum or value > maximum:
+    return None
+
+  return '{:.6f}'.format(value)
+
+
+def normalize_latitude(string=None):
+  return normalize_number(string, -90.0, 90.0)
+
+
+def normalize_longitude(string=None):
+  return normalize_number(string, -180.0, 180.0)
+
+
+def normalize_radius(string=None):
+  """ Radius in km, up to geo.MAX_RADIUS """
+  value = normalize_number(string, 0.0, geo.MAX_RADIUS)
+  return value if value and float(value) > 0 else None
+
+
+def normalize_facets(string=None):
+  """ Normalize a comma delimited list of facet fields """
+  if not string:
+    return None
+
+  return ','.join(sort_items(string.split(','))) or None
+
+
+#########################
+## Endpoint parameters ##
+#########################
+
+PROJECT_PARAMS = {
+  'query': normalize_text,
+  'cause': normalize_list,
+  'skill': normalize_list,
+  'address': normalize_address,
+  'highlighted': normalize_boolean,
+  'name': normalize_text,
+  'published': normalize_published,
+  'organization': normalize_id_list,
+  'not_organization': normalize_id_list,
+  'start_after': normalize_datetime,
+  'end_before': normalize_datetime,
+  'lat': normalize_latitude,
+  'lng': normalize_longitude,
+  'radius': normalize_radius,
+  'facets': normalize_facets,
+}
+
+ORGANIZATION_PARAMS = {
+  'query': normalize_text,
+  'cause': normalize_list,
+  'address': normalize_address,
+  'highlighted': normalize_boolean,
+  'name': normalize_text,
+  'published': normalize_published,
+  'lat': normalize_latitude,
+  'lng': normalize_longitude,
+  'radius': normalize_radius,
+  'facets': normalize_facets,
+}
+
+USER_PARAMS = {
+  'cause': normalize_list,
+  'skill': normalize_list,
+  'name': normalize_text,
+  'facets': normalize_facets,
+}
+
+
+def normalize(params, spec):
+  """
+  Parse request parameters into a canonical dict
+
+  Only parameters in spec are kept. Parameters that have no effect on the
+  query are dropped, so logically identical queries normalize the same.
+  """
+  normalized = {}
+  for name, normalizer in spec.items():
+    value = normalizer(params.get(name, None))
+    if value is not None:
+      normalized[name] = value
+  return normalized
+
+
+def get_cache_key(prefix, normalized):
+  """ Returns a cache key that is stable across processes """
+  payload = json.dumps(normalized, sort_keys=True, separators=(',', ':'))
+  digest = hashlib.sha1(payload.encode('utf-8')).hexdigest()
+  return '{}-{}'.format(prefix, digest)
@@ -0,0 +1,106 @@
+from django.db import connections as db_connections
+from haystack import connections
+
+from ovp_search import helpers
+from ovp_search.whoosh_backend import get_documents
+
+import multiprocessing
+import time
+
+"""
+Parallel index rebuild
+
+Each index_queryset is split into pk ranges. Worker processes load and
+prepare the documents for a range. On Whoosh, documents are sent back and
+written through a multi-segment writer, which analyzes them on its own
+processes. Other engines are written to directly by the workers.
+"""
+
+BATCH_SIZE = 1000
+
+
+def get_ranges(queryset, batch_size=BATCH_SIZE):
+  """ Split a queryset into (first pk, last pk) ranges of batch_size objects """
+  pks = list(queryset.order_by('pk').values_list('pk', flat=True))
+  return [(pks[i], pks[min(i + batch_size, len(pks)) - 1]) for i in range(0, len(pks), batch_size)]
+
+
+def prepare_range(args):
+  """
+  Index objects in a pk range, returns (count, documents)
+
+  On Whoosh, documents are returned to be written by the parent process.
+  """
+  using, model, first_pk, last_pk = args
+  index = connections[using].get_unified_index().get_index(model)
+  backend = connections[using].get_backend()
+
+  queryset = index.index_queryset(using=using).filter(pk__gte=first_pk, pk__lte=last_pk)
+  objects = list(queryset.order_by('pk'))
+
+  if not helpers.is_whoosh_backend(using):
+    backend.update(index, objects) # pragma: no cover
+    return len(objects), [] # pragma: no cover
+
+  docs = list(get_documents(backend, index, objects))
+  return len(docs), docs
+
+
+def get_writer(backend, workers):
+  """ Returns a Whoosh writer, writing one segment per process """
+  if workers > 1:
+    return backend.index.writer(procs=workers, multisegment=True)
+  return backend.index.writer()
+
+
+def rebuild(using='default', workers=0, batch_size=BATCH_SIZE):
+  """
+  Clear and rebuild every index on a connection
+
+  With workers=0 everything runs on the current process. Returns a list
+  of (model, count, seconds) for each index, and the total seconds
+  including the final commit.
+  """
+  started = time.time()
+  backend = connections[using].get_backend()
+  backend.clear()
+
+  is_whoosh = helpers.is_whoosh_backend(using)
+  writer = None
+  if is_whoosh:
+    backend.setup()
+    writer = get_writer(backend, workers)
+
+  pool = None
+  if workers:
+    # Workers must open their own database connections
+    db_connections.close_all()
+    pool = multiprocessing.Pool(workers)
+
+  stats = []
+  try:
+    for model in connections[using].get_unified_index().get_indexed_models():
+      model_started = time.time()
+      index = connections[using].get_unified_index().get_index(model)
+      tasks = [(using, model, first, last) for first, last in get_ranges(index.index_queryset(using=using), batch_size)]
+
+      count = 0
+      for range_count, docs in (pool.imap_unordered(prepare_range, tasks) if pool else map(prepare_range, tasks)):
+        for doc in docs:
+          writer.add_document(**doc)
+        count += range_count
+
+      stats.append((model, count, time.time() - model_started))
+  except Exception:
+    if writer:
+      writer.cancel()
+    raise
+  finally:
+    if pool:
+      pool.close()
+      pool.join()
+
+  if writer:
+    writer.commit()
+
+  return stats, time.time() - started
@@ -0,0 +1,73 @@
+from django.core.cache import cache
+from haystack.utils import get_model_ct
+
+from ovp_search import helpers
+
+import uuid
+
+"""
+Representation cache
+
+When OVP_SEARCH['CACHE_REPRESENTATIONS'] is enabled, the search serializer
+representation of each object is cached, keyed by model and pk, along with
+the object version it was rendered from. Signal processors bump the version
+of objects they reindex, so entries rendered from an older version are
+misses.
+
+Representations are rendered as index payloads are, for an anonymous user
+with host relative urls. A page takes a single cache.get_many for both the
+versions and the representations of its objects.
+"""
+
+CACHE_TTL = 600
+
+
+def is_enabled():
+  return bool(helpers.get_settings().get('CACHE_REPRESENTATIONS', False))
+
+
+def get_key(model, pk):
+  return 'ovp_search-representation-{}-{}'.format(get_model_ct(model), pk)
+
+
+def get_version_key(model, pk):
+  return 'ovp_search-representation-version-{}-{}'.format(get_model_ct(model), pk)
+
+
+def get_many(model, pks):
+  """
+  Returns ({pk: representation}, {pk: version}) for cached objects
+
+  Versions should be passed to set_many when caching the misses, so a bump
+  in between makes them stale.
+  """
+  keys = {pk: (get_key(model, pk), get_version_key(model, pk)) for pk in pks}
+  data = cache.get_many([key for pair in keys.values() for key in pair])
+
+  found = {}
+  versions = {}
+  for pk, (key, version_key) in keys.items():
+    version = versions[pk] = data.get(version_key, None)
+    entry = data.get(key, None)
+
+    if entry is not None and entry[0] == version:
+      found[pk] = entry[1]
+
+  return found, versions
+
+
+def set_many(model, representations, versions, ttl=CACHE_TTL):
+  """ Cache representations as {pk: representation}, rendered on versions returned by get_many """
+  cache.set_many({get_key(model, pk): (versions.get(pk, None), representation) for pk, representation in representations.items()}, ttl)
+
+
+def bump(model, pks):
+  """ Invalidate cached representations for objects """
+  if not is_enabled() or not pks:
+    return
+
+  version = uuid.uuid4().hex
+  cache.set_many({get_version_key(model, pk): version for pk in pks}, None)
+
+  # Stale entries could match again if version keys are evicted
+  cache.delete_many([get_key(model, pk) for pk in pks])
@@ -0,0 +1,72 @@
+from django.core.cache import cache
+
+from array import array
+
+"""
+Search results are cached as the ordered list of primary keys packed
+into an array, instead of pickled querysets. Objects are hydrated
+from the database per page.
+"""
+
+CACHE_TTL = 120
+
+# Empty results are cached too, cache.get returns None on misses
+EMPTY_RESULT = b'0'
+
+
+def pack_pks(pks):
+  """ Pack a list of integer primary keys into bytes """
+  if not pks:
+    return EMPTY_RESULT
+
+  typecode = 'I' if max(pks) <= 0xFFFFFFFF else 'Q'
+  return typecode.encode('ascii') + array(typecode, pks).tobytes()
+
+
+def unpack_pks(data):
+  """ Unpack bytes created by pack_pks into a list of primary keys """
+  if data == EMPTY_RESULT:
+    return []
+
+  pks = array(chr(data[0]))
+  pks.frombytes(data[1:])
+  return pks.tolist()
+
+
+def get_pks(key):
+  """ Returns cached primary keys or None if there is no cache entry """
+  data = cache.get(key)
+  if data is None:
+    return None
+  return unpack_pks(data)
+
+
+def set_pks(key, pks, ttl=CACHE_TTL):
+  """ Cache a list of primary keys """
+  cache.set(key, pack_pks([int(pk) for pk in pks]), ttl)
+
+
+def get_page_key(key, start, stop):
+  return '{}-{}-{}'.format(key, start, stop)
+
+
+def get_page(key, start, stop):
+  """ Returns a cached (count, pks, facets, payloads) tuple for a result window or None """
+  data = cache.get(get_page_key(key, start, stop))
+  if data is None:
+    return None
+  return data[0], unpack_pks(data[1]), data[2], data[3]
+
+
+def set_page(key, start, stop, count, pks, facets=None, payloads=None, ttl=CACHE_TTL):
+  """ Cache a result window together with the total hit count, facet counts and stored payloads """
+  cache.set(get_page_key(key, start, stop), (count, pack_pks([int(pk) for pk in pks]), facets, payloads), ttl)
+
+
+def get_facets(key):
+  """ Returns cached facet counts for a result or None """
+  return cache.get('{}-facets'.format(key))
+
+
+def set_facets(key, facets, ttl=CACHE_TTL):
+  cache.set('{}-facets'.format(key), facets, ttl)
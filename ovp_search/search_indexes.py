@@ -1,11 +1,15 @@
 from haystack import indexes
-from django.db.models import Q
 from ovp_projects.models import Project, Work, Job
 from ovp_organizations.models import Organization
-from ovp_core.models import GoogleAddress, SimpleAddress
 from ovp_users.models import User
 from ovp_users.models.profile import get_profile_model
 
+from ovp_projects.serializers.project import ProjectSearchSerializer
+from ovp_organizations.serializers import OrganizationSearchSerializer
+
+from ovp_search import helpers
+from ovp_search import payloads
+
 """
 Mixins(used by multiple indexes)
 """
@@ -21,27 +25,29 @@ class SkillsMixin:
 
 class AddressComponentsMixin:
   def prepare_address_components(self, obj):
-    types = []
+    return helpers.get_address_components(obj.address)
+
+class LocationMixin:
+  """ Coordinates of the address, for radius searches(see geo) """
+  def prepare_latitude(self, obj):
+    return helpers.get_coordinates(obj.address)[0]
 
-    if obj.address:
-      if type(obj.address) == GoogleAddress:
-        for component in obj.address.address_components.all():
-          for component_type in component.types.all():
-            types.append(u'{}-{}'.format(component.long_name, component_type.name))
+  def prepare_longitude(self, obj):
+    return helpers.get_coordinates(obj.address)[1]
 
-      if type(obj.address) == SimpleAddress:
-        if obj.address.city:
-          types.append(u'{}-{}'.format(obj.address.city, 'locality'))
-        if obj.address.country:
-          types.append(u'{}-{}'.format(obj.address.country, 'country'))
+class PayloadMixin:
+  """ Stores the search serializer representation if OVP_SEARCH['INDEX_PAYLOADS'] is enabled """
+  payload_serializer = None
 
-    return types
+  def prepare_payload(self, obj):
+    if payloads.is_enabled():
+      return payloads.render(self.payload_serializer, obj)
 
 
 """
 Indexes
 """
-class ProjectIndex(indexes.SearchIndex, indexes.Indexable, SkillsMixin, CausesMixin, AddressComponentsMixin):
+class ProjectIndex(indexes.SearchIndex, indexes.Indexable, SkillsMixin, CausesMixin, AddressComponentsMixin, LocationMixin, PayloadMixin):
   name = indexes.EdgeNgramField(model_attr='name')
   causes = indexes.MultiValueField(faceted=True)
   text = indexes.CharField(document=True, use_template=True)
@@ -52,8 +58,24 @@ class ProjectIndex(indexes.SearchIndex, indexes.Indexable, SkillsMixin, CausesMi
   deleted = indexes.BooleanField(model_attr='deleted')
   closed = indexes.BooleanField(model_attr='closed')
   address_components = indexes.MultiValueField(faceted=True)
+  organization = indexes.IntegerField(model_attr='organization_id', null=True)
+  owner = indexes.IntegerField(model_attr='owner_id')
+  published_date = indexes.DateTimeField(model_attr='published_date', null=True)
+  created_date = indexes.DateTimeField(model_attr='created_date')
+  max_applies = indexes.IntegerField(model_attr='max_applies')
+  minimum_age = indexes.IntegerField(model_attr='minimum_age')
+  job_start_date = indexes.DateTimeField(null=True)
+  job_end_date = indexes.DateTimeField(null=True)
+  work = indexes.IntegerField(null=True)
+  ongoing = indexes.BooleanField()
+  latitude = indexes.FloatField(null=True)
+  longitude = indexes.FloatField(null=True)
+  payload = indexes.CharField(indexed=False, null=True)
+
+  payload_serializer = ProjectSearchSerializer
 
   def prepare_can_be_done_remotely(self, obj):
+    # job and work are loaded by load_related
     can_be_done_remotely = False
 
     # Try to get info from work object
@@ -72,16 +94,44 @@ class ProjectIndex(indexes.SearchIndex, indexes.Indexable, SkillsMixin, CausesMi
 
     return can_be_done_remotely
 
+  def prepare_job_start_date(self, obj):
+    try:
+      return obj.job.start_date
+    except Job.DoesNotExist:
+      return None
+
+  def prepare_job_end_date(self, obj):
+    try:
+      return obj.job.end_date
+    except Job.DoesNotExist:
+      return None
+
+  def prepare_work(self, obj):
+    try:
+      return obj.work.pk
+    except Work.DoesNotExist:
+      return None
+
+  def prepare_ongoing(self, obj):
+    return self.prepare_work(obj) is not None
+
+  def load_related(self, queryset):
+    """ Load related objects used on prepare """
+    queryset = queryset.select_related('address', 'job', 'work', 'image', 'organization', 'owner', 'owner__avatar')
+    return queryset.prefetch_related('causes', 'skills', 'job__dates', *helpers.get_address_prefetch())
 
   def get_model(self):
     return Project
 
+  def get_updated_field(self):
+    return 'modified_date'
+
   def index_queryset(self, using=None):
-    return self.get_model().objects.filter(deleted=False)
+    return self.load_related(self.get_model().objects.filter(deleted=False))
 
 
 
-class OrganizationIndex(indexes.SearchIndex, indexes.Indexable, CausesMixin, AddressComponentsMixin):
+class OrganizationIndex(indexes.SearchIndex, indexes.Indexable, CausesMixin, AddressComponentsMixin, LocationMixin, PayloadMixin):
   name = indexes.EdgeNgramField(model_attr='name')
   causes = indexes.MultiValueField(faceted=True)
   text = indexes.CharField(document=True, use_template=True)
@@ -89,13 +139,26 @@ class OrganizationIndex(indexes.SearchIndex, indexes.Indexable, CausesMixin, Add
   address_components = indexes.MultiValueField(faceted=True)
   published = indexes.BooleanField(model_attr='published')
   deleted = indexes.BooleanField(model_attr='deleted')
+  owner = indexes.IntegerField(model_attr='owner_id')
+  latitude = indexes.FloatField(null=True)
+  longitude = indexes.FloatField(null=True)
+  payload = indexes.CharField(indexed=False, null=True)
+
+  payload_serializer = OrganizationSearchSerializer
 
+  def load_related(self, queryset):
+    """ Load related objects used on prepare """
+    queryset = queryset.select_related('address', 'image')
+    return queryset.prefetch_related('causes', *helpers.get_address_prefetch())
 
   def get_model(self):
     return Organization
 
+  def get_updated_field(self):
+    return 'modified_date'
+
   def index_queryset(self, using=None):
-    return self.get_model().objects.filter(deleted=False)
+    return self.load_related(self.get_model().objects.filter(deleted=False))
 
 
 class UserIndex(indexes.SearchIndex, indexes.Indexable, AddressComponentsMixin):
@@ -103,12 +166,27 @@ class UserIndex(indexes.SearchIndex, indexes.Indexable, AddressComponentsMixin):
   text = indexes.CharField(document=True)
   causes = indexes.MultiValueField(faceted=True)
   skills = indexes.MultiValueField(faceted=True)
+  public = indexes.BooleanField(model_attr='public')
+
+  def load_related(self, queryset):
+    """
+    Load related objects used on prepare
+
+    Users without a profile still cost a query, as User.profile falls
+    back to querying it.
+    """
+    profile = get_profile_model()._meta.get_field('user').related_query_name()
+    queryset = queryset.select_related(profile)
+    return queryset.prefetch_related(profile + '__causes', profile + '__skills')
 
   def get_model(self):
     return User
 
+  def get_updated_field(self):
+    return 'modified_date'
+
   def index_queryset(self, using=None):
-    return self.get_model().objects
+    return self.load_related(self.get_model().objects.all())
 
   def prepare_causes(self, obj):
     try:
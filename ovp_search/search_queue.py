@@ -0,0 +1,162 @@
+from django.apps import apps
+from django.utils import timezone
+from haystack import connections, connection_router
+
+from ovp_search.models import IndexQueueEntry
+from ovp_search.signals import IndexBatch
+
+from collections import OrderedDict
+from datetime import timedelta
+import uuid
+
+"""
+Durable index queue
+
+Request threads only insert IndexQueueEntry rows. The process_search_queue
+command drains them in batches, writing each object to the index once per
+batch. Entries that fail are retried with exponential backoff, without
+holding back the rest of their batch.
+
+Several workers can drain the queue at once. Each batch is claimed with a
+conditional UPDATE, so workers never process the same entries. Claims
+expire after CLAIM_TIMEOUT seconds, in case the worker dies.
+"""
+
+BATCH_SIZE = 100
+MAX_ATTEMPTS = 5
+BACKOFF = 30
+CLAIM_TIMEOUT = 300
+
+
+def get_backoff(attempts):
+  """ Returns how long to wait before retrying after a number of failed attempts """
+  return timedelta(seconds=BACKOFF * 2 ** (attempts - 1))
+
+
+def get_claimable(max_attempts=MAX_ATTEMPTS):
+  """ Entries that are available and not claimed by a running worker """
+  return IndexQueueEntry.objects.filter(available_date__lte=timezone.now(), attempts__lt=max_attempts)
+
+
+def claim(queryset, token):
+  """ Claim entries on queryset that are still claimable, in a single UPDATE """
+  now = timezone.now()
+  queryset = queryset.filter(available_date__lte=now)
+  return queryset.update(claim=token, available_date=now + timedelta(seconds=CLAIM_TIMEOUT))
+
+
+def claim_pending(batch_size=BATCH_SIZE, max_attempts=MAX_ATTEMPTS):
+  """
+  Claim entries that are ready to be processed, oldest first
+
+  Newer entries for the same objects are claimed along, they are covered
+  by the same write, since objects are reloaded from the database when
+  the batch is flushed. Returns the claimed entries.
+  """
+  token = uuid.uuid4().hex
+  pks = list(get_claimable(max_attempts).order_by('pk').values_list('pk', flat=True)[:batch_size])
+  if not pks or not claim(IndexQueueEntry.objects.filter(pk__in=pks), token):
+    return []
+
+  entries = list(IndexQueueEntry.objects.filter(claim=token))
+  keys = set((entry.model, entry.object_id) for entry in entries)
+  queryset = get_claimable(max_attempts).filter(model__in=set(k[0] for k in keys), object_id__in=set(k[1] for k in keys))
+
+  duplicates = [entry.pk for entry in queryset if (entry.model, entry.object_id) in keys]
+  if duplicates:
+    claim(IndexQueueEntry.objects.filter(pk__in=duplicates), token)
+
+  return list(IndexQueueEntry.objects.filter(claim=token).order_by('pk'))
+
+
+def reschedule(entries, error):
+  """ Retry entries later, waiting longer after each failed attempt """
+  for entry in entries:
+    entry.attempts += 1
+    entry.available_date = timezone.now() + get_backoff(entry.attempts)
+    entry.last_error = repr(error)
+    entry.claim = ''
+    entry.save(update_fields=['attempts', 'available_date', 'last_error', 'claim'])
+
+
+def get_objects(entries):
+  """
+  Group entries by object, returns ([(model, object_id, entries), ...], failed)
+
+  Entries whose model can't be resolved are returned on failed, along
+  with the error.
+  """
+  objects = OrderedDict()
+  failed = []
+  for entry in entries:
+    try:
+      model = apps.get_model(entry.model)
+    except (LookupError, ValueError) as e:
+      failed.append(([entry], e))
+      continue
+    objects.setdefault((model, entry.object_id), []).append(entry)
+
+  return [(model, object_id, group) for (model, object_id), group in objects.items()], failed
+
+
+def write(objects):
+  """
+  Write objects to the index, returns [(entries, error), ...] that failed
+
+  Objects are written in a single batch. If it fails, it's split in halves
+  which are retried on their own, until the objects failing are found.
+  """
+  try:
+    batch = IndexBatch(connections, connection_router)
+    for model, object_id, entries in objects:
+      for entry in entries:
+        batch.add(entry.action, model, [object_id])
+    batch.flush()
+  except Exception as e:
+    if len(objects) == 1:
+      return [(objects[0][2], e)]
+
+    middle = len(objects) // 2
+    return write(objects[:middle]) + write(objects[middle:])
+
+  return []
+
+
+def process_batch(batch_size=BATCH_SIZE, max_attempts=MAX_ATTEMPTS):
+  """
+  Process a batch of entries and returns (processed, failed) entry counts
+
+  Entries for the same object are coalesced, the most recent action wins.
+  Processed entries are deleted, failed entries are rescheduled on their
+  own, with their error.
+  """
+  entries = claim_pending(batch_size, max_attempts)
+  if not entries:
+    return 0, 0
+
+  objects, failed = get_objects(entries)
+  failed += write(objects)
+
+  failed_pks = set()
+  for failed_entries, error in failed:
+    reschedule(failed_entries, error)
+    failed_pks.update(entry.pk for entry in failed_entries)
+
+  IndexQueueEntry.objects.filter(pk__in=[entry.pk for entry in entries if entry.pk not in failed_pks]).delete()
+  return len(entries) - len(failed_pks), len(failed_pks)
+
+
+def process(batch_size=BATCH_SIZE, max_attempts=MAX_ATTEMPTS):
+  """ Drain the queue and returns (processed, failed) entry counts """
+  processed = 0
+  failed = 0
+
+  while True:
+    batch_processed, batch_failed = process_batch(batch_size, max_attempts)
+
+    # Batches come back empty when another worker claimed the entries first
+    if not batch_processed and not batch_failed and not get_claimable(max_attempts).exists():
+      return processed, failed
+
+    processed += batch_processed
+    failed += batch_failed
@@ -1,5 +1,10 @@
 from django.db import models
+from django.db import transaction
+from django.utils import timezone
 from haystack import signals
+from haystack.exceptions import NotHandled
+from haystack.utils import get_identifier
+from haystack.utils import get_model_ct
 
 from ovp_projects.models import Project, Job, Work
 from ovp_organizations.models import Organization
@@ -7,6 +12,20 @@ from ovp_core.models import GoogleAddress
 from ovp_users.models import User
 from ovp_users.models.profile import get_profile_model
 
+from ovp_search import affinity
+from ovp_search import cities
+from ovp_search import hydration
+from ovp_search import representations
+from ovp_search.models import IndexQueueEntry
+
+from collections import OrderedDict
+import threading
+
+
+def is_post_m2m_action(kwargs):
+  """ pre_* m2m actions run before the relation changes, there's nothing to index yet """
+  return kwargs.get('action', 'post_add').startswith('post_')
+
 
 class TiedModelRealtimeSignalProcessor(signals.BaseSignalProcessor):
   """
@@ -60,11 +79,40 @@ class TiedModelRealtimeSignalProcessor(signals.BaseSignalProcessor):
     for item in self.m2m_user:
       models.signals.m2m_changed.disconnect(self.handle_m2m_user, sender=item)
 
+  def handle_save(self, sender, instance, **kwargs):
+    """ Reindex instance and update the available cities it is counted on """
+    super(TiedModelRealtimeSignalProcessor, self).handle_save(sender, instance, **kwargs)
+    representations.bump(instance.__class__, [instance.pk])
+    cities.update_object(instance)
+
+  def handle_delete(self, sender, instance, **kwargs):
+    """ Remove instance from index and from available cities """
+    super(TiedModelRealtimeSignalProcessor, self).handle_delete(sender, instance, **kwargs)
+    representations.bump(instance.__class__, [instance.pk])
+    cities.remove_object(instance)
+
+  def queue(self, action, model, pks):
+    """ Write objects to the index in bulk """
+    batch = IndexBatch(self.connections, self.connection_router)
+    batch.add(action, model, pks)
+    batch.flush()
+
+  def touch(self, model, pks):
+    """
+    Bump the updated field of objects whose related objects changed
+
+    Related objects have no modification date of their own, this lets
+    update_search_index pick up changes that failed to reach the index.
+    """
+    batch = IndexBatch(self.connections, self.connection_router)
+    batch.touch(model, pks)
+    batch.flush()
+
   def handle_address_save(self, sender, instance, **kwargs):
     """ Custom handler for address save """
-    objects = self.find_associated_with_address(instance)
-    for obj in objects:
-      self.handle_save(obj.__class__, obj)
+    for model, pks in self.find_associated_with_address(instance).items():
+      self.touch(model, pks)
+      self.queue(IndexBatch.UPDATE, model, pks)
 
   # this function is never really called on sqlite dbs
   def handle_address_delete(self, sender, instance, **kwargs):
@@ -73,23 +121,33 @@ class TiedModelRealtimeSignalProcessor(signals.BaseSignalProcessor):
 
     # this is not called as django will delete associated project/address
     # triggering handle_delete
-    for obj in objects: # pragma: no cover
-      self.handle_delete(obj.__class__, obj)
+    for model, pks in objects.items(): # pragma: no cover
+      self.queue(IndexBatch.REMOVE, model, pks)
 
   def handle_job_and_work_save(self, sender, instance, **kwargs):
     """ Custom handler for job and work save """
+    if instance.project_id is None:
+      return
+    self.touch(Project, [instance.project_id])
     self.handle_save(instance.project.__class__, instance.project)
 
   def handle_job_and_work_delete(self, sender, instance, **kwargs):
     """ Custom handler for job and work delete """
+    if instance.project_id is None:
+      return
+    self.touch(Project, [instance.project_id])
     self.handle_delete(instance.project.__class__, instance.project)
 
   def handle_profile_save(self, sender, instance, **kwargs):
     """ Custom handler for user profile save """
+    affinity.invalidate_affinity(instance.user_id)
+    self.touch(User, [instance.user_id])
     self.handle_save(instance.user.__class__, instance.user)
 
   def handle_profile_delete(self, sender, instance, **kwargs):
     """ Custom handler for user profile delete """
+    affinity.invalidate_affinity(instance.user_id)
+    self.touch(User, [instance.user_id])
     try:
       self.handle_save(instance.user.__class__, instance.user) # we call save just as well
     except (get_profile_model().DoesNotExist):
@@ -97,16 +155,213 @@ class TiedModelRealtimeSignalProcessor(signals.BaseSignalProcessor):
 
   def handle_m2m(self, sender, instance, **kwargs):
     """ Handle many to many relationships """
+    if not is_post_m2m_action(kwargs):
+      return
+    self.touch(instance.__class__, [instance.pk])
     self.handle_save(instance.__class__, instance)
 
   def handle_m2m_user(self, sender, instance, **kwargs):
     """ Handle many to many relationships for user field """
+    if not is_post_m2m_action(kwargs):
+      return
+    affinity.invalidate_affinity(instance.user_id)
+    self.touch(User, [instance.user_id])
     self.handle_save(instance.user.__class__, instance.user)
 
   def find_associated_with_address(self, instance):
-    """ Returns list with projects and organizations associated with given address """
-    objects = []
-    objects += list(Project.objects.filter(address=instance))
-    objects += list(Organization.objects.filter(address=instance))
+    """ Returns a dict with pks of projects and organizations associated with given address """
+    objects = OrderedDict()
+    for model in (Project, Organization):
+      pks = list(model.objects.filter(address=instance).values_list('pk', flat=True))
+      if pks:
+        objects[model] = pks
 
     return objects
+
+
+class IndexBatch(object):
+  """
+    IndexBatch collects objects to update or remove from the index
+
+    Objects are keyed by (model, pk), so an object touched several times is
+    written once, with the last action recorded. Updates are reloaded from
+    the database on flush, with the related objects their index prepares
+    from, and sent to the backend in a single update per model.
+
+    Touched objects get their updated field bumped on flush, in a single
+    UPDATE per model, before the index is written.
+
+  """
+  UPDATE = 'update'
+  REMOVE = 'remove'
+
+  def __init__(self, connections, connection_router):
+    self.connections = connections
+    self.connection_router = connection_router
+    self.pending = OrderedDict()
+    self.touched = OrderedDict()
+
+  def __len__(self):
+    return len(self.pending)
+
+  def add(self, action, model, pks):
+    for pk in pks:
+      key = (model, pk)
+      self.pending.pop(key, None)
+      self.pending[key] = action
+
+  def touch(self, model, pks):
+    """ Bump the updated field of objects on flush """
+    self.touched.setdefault(model, set()).update(pk for pk in pks if pk is not None)
+
+  def flush(self):
+    pending, self.pending = self.pending, OrderedDict()
+    touched, self.touched = self.touched, OrderedDict()
+
+    for model, pks in touched.items():
+      self.bump_updated_field(model, pks)
+
+    updates = OrderedDict()
+    removes = OrderedDict()
+    for (model, pk), action in pending.items():
+      target = updates if action == self.UPDATE else removes
+      target.setdefault(model, []).append(pk)
+
+    for model, pks in updates.items():
+      objects = list(self.get_queryset(model, pks))
+      self.update(model, objects)
+
+      # Deleted before the transaction was committed
+      found = set(obj.pk for obj in objects)
+      removes.setdefault(model, []).extend(pk for pk in pks if pk not in found)
+
+    for model, pks in removes.items():
+      self.remove(model, pks)
+
+  def bump_updated_field(self, model, pks):
+    if not pks:
+      return
+
+    for using in self.connection_router.for_write(model=model):
+      try:
+        index = self.connections[using].get_unified_index().get_index(model)
+      except NotHandled:
+        continue
+
+      updated_field = index.get_updated_field()
+      if updated_field:
+        model._default_manager.filter(pk__in=pks).update(**{updated_field: timezone.now()})
+      return
+
+  def get_queryset(self, model, pks):
+    """ Returns objects for pks, loading related objects through the index load_related """
+    queryset = hydration.filter_pks(model._default_manager.all(), pks)
+
+    for using in self.connection_router.for_write(model=model):
+      try:
+        index = self.connections[using].get_unified_index().get_index(model)
+      except NotHandled:
+        continue
+
+      if hasattr(index, 'load_related'):
+        return index.load_related(queryset)
+
+    return queryset
+
+  def update(self, model, objects):
+    for using in self.connection_router.for_write(model=model):
+      try:
+        index = self.connections[using].get_unified_index().get_index(model)
+      except NotHandled:
+        continue
+
+      objects_to_update = [obj for obj in objects if index.should_update(obj)]
+      if objects_to_update:
+        self.connections[using].get_backend().update(index, objects_to_update)
+
+    representations.bump(model, [obj.pk for obj in objects])
+    for obj in objects:
+      cities.update_object(obj)
+
+  def remove(self, model, pks):
+    for using in self.connection_router.for_write(model=model):
+      try:
+        self.connections[using].get_unified_index().get_index(model)
+      except NotHandled:
+        continue
+
+      backend = self.connections[using].get_backend()
+      for pk in pks:
+        backend.remove(get_identifier(model(pk=pk)))
+
+    representations.bump(model, pks)
+    for pk in pks:
+      cities.remove_object(model(pk=pk))
+
+
+class TiedModelCoalescingSignalProcessor(TiedModelRealtimeSignalProcessor):
+  """
+    TiedModelCoalescingSignalProcessor reindexes once per transaction
+
+    Signals only mark objects as dirty. Dirty objects are written to the
+    index when the transaction commits, each object once. Outside of a
+    transaction objects are written right away. Use ATOMIC_REQUESTS to
+    coalesce every change made during a request.
+
+  """
+  def __init__(self, *args, **kwargs):
+    self._local = threading.local()
+    super(TiedModelCoalescingSignalProcessor, self).__init__(*args, **kwargs)
+
+  def get_batch(self):
+    """ Returns the batch flushed when the current transaction commits """
+    connection = transaction.get_connection()
+    batch = getattr(self._local, 'batch', None)
+
+    # Callbacks are discarded on rollback and after running on commit
+    if batch is None or not any(func == batch.flush for sids, func in connection.run_on_commit):
+      batch = self._local.batch = IndexBatch(self.connections, self.connection_router)
+      transaction.on_commit(batch.flush)
+
+    return batch
+
+  def queue(self, action, model, pks):
+    """ Mark objects to be written to the index on commit """
+    if not transaction.get_connection().in_atomic_block:
+      return super(TiedModelCoalescingSignalProcessor, self).queue(action, model, pks)
+
+    self.get_batch().add(action, model, pks)
+
+  def touch(self, model, pks):
+    """ Mark objects to have their updated field bumped on commit """
+    if not transaction.get_connection().in_atomic_block:
+      return super(TiedModelCoalescingSignalProcessor, self).touch(model, pks)
+
+    self.get_batch().touch(model, pks)
+
+  def handle_save(self, sender, instance, **kwargs):
+    """ Mark instance to be reindexed on commit """
+    self.queue(IndexBatch.UPDATE, instance.__class__, [instance.pk])
+
+  def handle_delete(self, sender, instance, **kwargs):
+    """ Mark instance to be removed from index on commit """
+    self.queue(IndexBatch.REMOVE, instance.__class__, [instance.pk])
+
+
+class TiedModelQueuedSignalProcessor(TiedModelCoalescingSignalProcessor):
+  """
+    TiedModelQueuedSignalProcessor defers indexing to a worker
+
+    Signals only insert an IndexQueueEntry row, within the same transaction
+    as the change. Entries are written to the index by the
+    process_search_queue command.
+
+  """
+  def queue(self, action, model, pks):
+    """ Insert queue entries for objects """
+    entries = [IndexQueueEntry(model=get_model_ct(model), object_id=pk, action=action) for pk in pks]
+    IndexQueueEntry.objects.bulk_create(entries)
+
+  def touch(self, model, pks):
+    """ Entries are retried by the worker until written, there's nothing for update_search_index to pick up """
+    pass
@@ -0,0 +1,41 @@
+from django.test import TestCase
+
+from haystack.query import SearchQuerySet, SQ
+
+from ovp_search import compiler
+from ovp_search import helpers
+
+import warnings
+
+
+class QueryCompilerTestCase(TestCase):
+  def test_compiler_is_resolved_once_per_alias(self):
+    """ Test compilers are cached per connection alias """
+    self.assertTrue(compiler.get_compiler() is compiler.get_compiler('default'))
+    self.assertTrue(isinstance(compiler.get_compiler(), compiler.WhooshQueryCompiler))
+
+  def test_terms_are_narrow_queries(self):
+    """ Test keyword fields are filtered by narrow queries """
+    queryset = compiler.get_compiler().filter(SearchQuerySet(), 'causes', ['1', '2'], SQ.AND)
+    self.assertEqual(queryset.query.narrow_queries, set([u'causes:("1" AND "2")']))
+
+    queryset = compiler.get_compiler().filter(SearchQuerySet(), 'causes', [])
+    self.assertEqual(queryset.query.narrow_queries, set())
+
+  def test_quoting(self):
+    """ Test values are quoted for each backend """
+    self.assertEqual(compiler.get_compiler().quote(u'São Paulo-locality'), u'"São Paulo-locality"')
+    self.assertEqual(compiler.get_compiler().quote(u'a "b"'), u"'a \"b\"'")
+
+    term_compiler = compiler.TermQueryCompiler('default')
+    self.assertEqual(term_compiler.quote(u'a "b" \\'), u'"a \\"b\\" \\\\"')
+    self.assertEqual(term_compiler.terms('address_components', [u'a', u'b']), u'address_components_exact:("a" OR "b")')
+
+  def test_whoosh_raw_is_deprecated(self):
+    """ Test helpers.whoosh_raw still returns raw terms, with a deprecation warning """
+    with warnings.catch_warnings(record=True) as caught:
+      warnings.simplefilter('always')
+      term = helpers.whoosh_raw(u'São Paulo-locality')
+
+    self.assertEqual(term.query_string, u'("São Paulo-locality")')
+    self.assertTrue(issubclass(caught[0].category, DeprecationWarning))
@@ -1,7 +1,14 @@
 import ovp_search.apps
 from django.test import TestCase
 from django.core.management import call_command
+from django.utils.six import StringIO
 
 class RebuildIndexTestCase(TestCase):
   def test_rebuild_index_execution(self):
     call_command('rebuild_index', '--noinput', verbosity=0)
+
+class BenchmarkHydrationTestCase(TestCase):
+  def test_benchmark_hydration_execution(self):
+    out = StringIO()
+    call_command('benchmark_hydration', '--sizes', '10,20', '--repeat', '1', stdout=out)
+    self.assertTrue("10" in out.getvalue())
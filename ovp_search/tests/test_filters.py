@@ -0,0 +1,35 @@
+from django.test import TestCase
+
+from ovp_search import filters
+
+
+class AddressPlanTestCase(TestCase):
+  def setUp(self):
+    filters.compile_address.cache_clear()
+
+  def test_components_compile_to_terms(self):
+    """ Test each component compiles to its ORed terms and plans are cached """
+    address = '{"address_components":[{"long_name":"Brazil","types":["country"]},{"long_name":"S\\u00e3o Paulo","types":["administrative_area_level_2","locality"]}]}'
+    plan = filters.compile_address(address)
+    self.assertEqual(plan, (("Brazil-country",), (u"São Paulo-administrative_area_level_2", u"São Paulo-locality")))
+
+    self.assertTrue(filters.compile_address(address) is plan)
+    self.assertEqual(filters.compile_address.cache_info().hits, 1)
+
+  def test_redundant_components_are_collapsed(self):
+    """ Test components that include every term of another component are dropped """
+    address = '{"address_components":[{"long_name":"Brazil","types":["country","political"]},{"long_name":"Brazil","types":["country"]}]}'
+    self.assertEqual(filters.compile_address(address), (("Brazil-country",),))
+
+  def test_remote_and_empty_addresses(self):
+    """ Test addresses without components filter remote projects """
+    self.assertEqual(filters.compile_address('{"address_components":[]}'), ())
+    self.assertEqual(filters.compile_address('{}'), None)
+
+  def test_region_aliases(self):
+    """ Test regions compile to a single component with a term per country """
+    address = '{"address_components":[{"long_name":"Caribbean","types":["country"]}]}'
+    self.assertEqual(len(filters.compile_address(address)[0]), 5)
+
+    with self.settings(OVP_SEARCH={'REGION_ALIASES': {'Caribbean': ['Jamaica', 'Haiti']}}):
+      self.assertEqual(filters.compile_address(address), (("Jamaica-country", "Haiti-country"),))
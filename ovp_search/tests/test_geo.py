@@ -0,0 +1,25 @@
+from django.test import TestCase
+
+from ovp_search import geo
+
+
+class GeoTestCase(TestCase):
+  def test_location(self):
+    """ Test locations need coordinates and radius """
+    self.assertEqual(geo.get_location({'lat': '-23.550500', 'lng': '-46.633300', 'radius': '10.000000'}), (-23.5505, -46.6333, 10.0))
+    self.assertEqual(geo.get_location({'lat': '-23.550500', 'lng': '-46.633300'}), None)
+
+  def test_bounding_box(self):
+    """ Test bounding boxes are split on the antimeridian and span every longitude on poles """
+    south, north, ranges = geo.get_bounding_box(0, 179.9, 50)
+    self.assertEqual(len(ranges), 2)
+    self.assertEqual(ranges[0][1], 180.0)
+    self.assertEqual(ranges[1][0], -180.0)
+
+    south, north, ranges = geo.get_bounding_box(89.9, 0, 50)
+    self.assertEqual((north, ranges), (90.0, [(-180.0, 180.0)]))
+
+  def test_distance(self):
+    """ Test great circle distance in km """
+    self.assertAlmostEqual(geo.distance(-23.5505, -46.6333, -22.9099, -47.0626), 83.6, places=0)
+    self.assertEqual(geo.distance(10, 10, 10, 10), 0)
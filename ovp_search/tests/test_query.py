@@ -0,0 +1,75 @@
+from django.test import TestCase
+
+from ovp_search import query
+
+
+class QueryNormalizationTestCase(TestCase):
+  def test_list_normalization(self):
+    """ Test cause and skill lists are deduped, sorted and get an explicit operator """
+    self.assertEqual(query.normalize_list("1,3"), "OR,1,3")
+    self.assertEqual(query.normalize_list("3,1"), "OR,1,3")
+    self.assertEqual(query.normalize_list("OR,1,3,3"), "OR,1,3")
+    self.assertEqual(query.normalize_list("AND,10,2,"), "AND,2,10")
+    self.assertEqual(query.normalize_list("AND"), None)
+    self.assertEqual(query.normalize_list(""), None)
+
+  def test_id_list_normalization(self):
+    """ Test organization lists are deduped and sorted """
+    self.assertEqual(query.normalize_id_list("3,1,3"), "1,3")
+    self.assertEqual(query.normalize_id_list(","), None)
+
+  def test_published_normalization(self):
+    """ Test published defaults to 'true' and unknown values mean both """
+    self.assertEqual(query.normalize_published(None), "true")
+    self.assertEqual(query.normalize_published("false"), "false")
+    self.assertEqual(query.normalize_published("anything"), "both")
+
+  def test_datetime_normalization(self):
+    """ Test dates and datetimes are normalized to UTC and invalid values are ignored """
+    self.assertEqual(query.normalize_datetime("2030-01-10"), "2030-01-10T00:00:00Z")
+    self.assertEqual(query.normalize_datetime("2030-01-10T10:30:00"), "2030-01-10T10:30:00Z")
+    self.assertEqual(query.normalize_datetime("2030-01-10T10:30:00-03:00"), "2030-01-10T13:30:00Z")
+    self.assertEqual(query.normalize_datetime("2030-13-10"), None)
+    self.assertEqual(query.normalize_datetime("invalid"), None)
+
+  def test_location_normalization(self):
+    """ Test coordinates and radius are normalized and out of range values are ignored """
+    self.assertEqual(query.normalize_latitude("-23.5505"), "-23.550500")
+    self.assertEqual(query.normalize_longitude("-46.6333000001"), "-46.633300")
+    self.assertEqual(query.normalize_latitude("91"), None)
+    self.assertEqual(query.normalize_longitude("nan"), None)
+    self.assertEqual(query.normalize_radius("10"), "10.000000")
+    self.assertEqual(query.normalize_radius("0"), None)
+    self.assertEqual(query.normalize_radius("100000"), None)
+    self.assertEqual(query.normalize_radius(None), None)
+
+  def test_address_normalization(self):
+    """ Test address json is canonicalized """
+    a = '{"address_components":[{"types":["locality", "administrative_area_level_2"], "long_name":"São Paulo"}, {"types":["country"], "long_name":"Brazil"}]}'
+    b = '{"address_components": [{"long_name":"Brazil", "types":["country"]}, {"long_name":"São Paulo", "types":["administrative_area_level_2", "locality", "locality"]}], "extra": 1}'
+    self.assertEqual(query.normalize_address(a), query.normalize_address(b))
+
+    self.assertEqual(query.normalize_address('{"address_components":[]}'), '{"address_components":[]}')
+    self.assertEqual(query.normalize_address('{}'), None)
+
+  def test_caribbean_keeps_first_component(self):
+    """ Test region filters are not reordered """
+    address = '{"address_components":[{"types":["country"], "long_name":"Caribbean"}, {"types":["country"], "long_name":"Brazil"}]}'
+    normalized = query.normalize_address(address)
+    self.assertIn("Caribbean", normalized)
+    self.assertNotIn("Brazil", normalized)
+
+  def test_equivalent_queries_share_cache_key(self):
+    """ Test logically identical queries get the same cache key """
+    a = query.normalize({"cause": "1,3", "page": "2"}, query.PROJECT_PARAMS)
+    b = query.normalize({"cause": "OR,3,1", "published": "true"}, query.PROJECT_PARAMS)
+    c = query.normalize({"cause": "AND,1,3"}, query.PROJECT_PARAMS)
+
+    self.assertEqual(query.get_cache_key("projects", a), query.get_cache_key("projects", b))
+    self.assertNotEqual(query.get_cache_key("projects", a), query.get_cache_key("projects", c))
+    self.assertNotEqual(query.get_cache_key("projects", a), query.get_cache_key("organizations", a))
+
+  def test_cache_key_is_stable(self):
+    """ Test cache keys do not depend on hash randomization """
+    key = query.get_cache_key("projects", {"published": "true"})
+    self.assertEqual(key, "projects-60147553c9bd39bcb0826c9e46a5377032e46af1")
@@ -0,0 +1,32 @@
+from django.test import TestCase
+from django.core.cache import cache
+
+from ovp_search import result_cache
+
+
+class ResultCacheTestCase(TestCase):
+  def setUp(self):
+    cache.clear()
+
+  def test_pack_and_unpack(self):
+    """ Test primary keys survive packing and keep their order """
+    pks = [5, 1, 4294967295, 3]
+    self.assertEqual(result_cache.unpack_pks(result_cache.pack_pks(pks)), pks)
+
+    pks = [4294967296, 1]
+    self.assertEqual(result_cache.unpack_pks(result_cache.pack_pks(pks)), pks)
+
+  def test_pack_is_compact(self):
+    """ Test primary keys are packed as 4 byte integers """
+    self.assertEqual(len(result_cache.pack_pks(list(range(1000)))), 4001)
+
+  def test_empty_result(self):
+    """ Test empty results are cached and distinguishable from misses """
+    self.assertEqual(result_cache.get_pks("test-key"), None)
+    result_cache.set_pks("test-key", [])
+    self.assertEqual(result_cache.get_pks("test-key"), [])
+
+  def test_get_and_set(self):
+    """ Test string primary keys from the search engine are cached as integers """
+    result_cache.set_pks("test-key", ["3", "1", "2"])
+    self.assertEqual(result_cache.get_pks("test-key"), [3, 1, 2])
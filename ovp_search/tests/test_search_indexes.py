@@ -0,0 +1,149 @@
+from django.core.management import call_command
+from django.db import connection
+from django.test import TestCase
+from django.test.utils import override_settings, CaptureQueriesContext
+from django.utils import timezone
+
+from ovp_users.models import User
+from ovp_users.models.profile import get_profile_model
+from ovp_projects.models import Project, Job, Work
+from ovp_organizations.models import Organization
+from ovp_core.models import GoogleAddress, Cause, Skill
+
+from ovp_search import rebuild
+from ovp_search import watermarks
+
+from haystack import connections
+from haystack.query import SearchQuerySet
+
+from datetime import timedelta
+
+def index_queries(model):
+  """ Returns how many queries indexing every object for a model takes """
+  index = connections['default'].get_unified_index().get_index(model)
+  backend = connections['default'].get_backend()
+
+  with CaptureQueriesContext(connection) as context:
+    backend.update(index, index.build_queryset())
+
+  return len(context)
+
+@override_settings(OVP_CORE={'MAPS_API_LANGUAGE': 'en_US'})
+class IndexQueriesTestCase(TestCase):
+  def setUp(self):
+    self.user = User.objects.create_user(email="testmail@test.com", password="test_returned")
+    self.cause = Cause.objects.all().order_by('pk').first()
+    self.skill = Skill.objects.all().order_by('pk').first()
+
+  def create_project(self, i):
+    address = GoogleAddress(typed_address="São paulo, SP - Brazil")
+    address.save()
+
+    project = Project(name="test project", slug="test-slug-{}".format(i), details="abc", description="abc", owner=self.user, address=address, published=True)
+    project.save()
+    project.causes.add(self.cause)
+    project.skills.add(self.skill)
+
+    disponibility = Job(project=project) if i % 2 else Work(project=project)
+    disponibility.save()
+
+  def create_organization(self, i):
+    address = GoogleAddress(typed_address="São paulo, SP - Brazil")
+    address.save()
+
+    organization = Organization(name="test organization {}".format(i), details="abc", owner=self.user, address=address, published=True, type=0)
+    organization.save()
+    organization.causes.add(self.cause)
+
+  def create_user(self, i):
+    user = User.objects.create_user(email="testmail{}@test.com".format(i), password="test_returned")
+    profile = get_profile_model()(user=user)
+    profile.save()
+    profile.causes.add(self.cause)
+    profile.skills.add(self.skill)
+
+  def assertConstantQueries(self, model, create):
+    # Projects alternate between Job and Work, so the first two cover both
+    create(0)
+    create(1)
+    queries = index_queries(model)
+
+    for i in range(2, 5):
+      create(i)
+    self.assertEqual(index_queries(model), queries)
+
+  def test_project_index_queries(self):
+    """ Test indexing projects takes a constant number of queries """
+    self.assertConstantQueries(Project, self.create_project)
+
+  def test_organization_index_queries(self):
+    """ Test indexing organizations takes a constant number of queries """
+    self.assertConstantQueries(Organization, self.create_organization)
+
+  def test_user_index_queries(self):
+    """ Test indexing users takes a constant number of queries """
+    self.user.delete()
+    self.assertConstantQueries(User, self.create_user)
+
+
+@override_settings(OVP_CORE={'MAPS_API_LANGUAGE': 'en_US'})
+class WatermarkTestCase(TestCase):
+  def setUp(self):
+    self.user = User.objects.create_user(email="testmail@test.com", password="test_returned")
+    self.project = Project(name="test project", slug="test-slug", details="abc", description="abc", owner=self.user, published=True)
+    self.project.save()
+
+  def update(self):
+    call_command('clear_index', '--noinput', verbosity=0)
+    call_command('update_search_index', verbosity=0)
+    return SearchQuerySet().models(Project).all().count()
+
+  def test_first_run_indexes_everything(self):
+    """ Test objects are all indexed if there is no watermark """
+    self.assertEqual(self.update(), 1)
+    self.assertTrue(watermarks.get_watermark('default', Project))
+
+  def test_only_modified_objects_are_reindexed(self):
+    """ Test objects modified before the watermark are not reindexed """
+    self.update()
+    Project.objects.update(modified_date=timezone.now() - timedelta(days=1))
+    self.assertEqual(self.update(), 0)
+
+    # Related changes bump modified_date
+    Job(project=self.project).save()
+    self.assertEqual(self.update(), 1)
+
+  def test_modified_objects_out_of_index_queryset_are_removed(self):
+    """ Test objects modified since the watermark and excluded from index queryset get removed """
+    self.update()
+    self.assertEqual(watermarks.update('default', Project), (1, 0))
+
+    Project.objects.update(deleted=True, modified_date=timezone.now())
+    self.assertEqual(watermarks.update('default', Project), (0, 1))
+
+
+@override_settings(OVP_CORE={'MAPS_API_LANGUAGE': 'en_US'})
+class RebuildTestCase(TestCase):
+  def setUp(self):
+    self.user = User.objects.create_user(email="testmail@test.com", password="test_returned")
+    for i in range(3):
+      project = Project(name="test project", slug="test-slug-{}".format(i), details="abc", description="abc", owner=self.user, published=True)
+      project.save()
+
+  def test_get_ranges(self):
+    """ Test querysets are split in pk ranges of batch_size objects """
+    pks = list(Project.objects.order_by('pk').values_list('pk', flat=True))
+    self.assertEqual(rebuild.get_ranges(Project.objects.all(), 2), [(pks[0], pks[1]), (pks[2], pks[2])])
+    self.assertEqual(rebuild.get_ranges(Project.objects.none(), 2), [])
+
+  def test_rebuild(self):
+    """ Test rebuilding clears the index and indexes every object """
+    Project.objects.filter(pk=Project.objects.order_by('pk').first().pk).update(deleted=True)
+
+    stats, seconds = rebuild.rebuild('default', workers=0, batch_size=2)
+    self.assertEqual(dict((model, count) for model, count, s in stats)[Project], 2)
+    self.assertTrue(SearchQuerySet().models(Project).all().count() == 2)
+    self.assertTrue(SearchQuerySet().models(User).all().count() == 1)
+
+    call_command('rebuild_search_index', workers=0, verbosity=0)
+    self.assertTrue(SearchQuerySet().models(Project).all().count() == 2)
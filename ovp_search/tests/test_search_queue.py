@@ -0,0 +1,132 @@
+from django.test import TestCase
+from django.test.utils import override_settings
+from django.core.management import call_command
+from django.utils import timezone
+
+from ovp_users.models import User
+from ovp_projects.models import Project
+from ovp_search.models import IndexQueueEntry
+from ovp_search import search_queue
+
+from haystack import connections
+from haystack.query import SearchQuerySet
+from haystack.utils import get_model_ct
+
+from unittest import mock
+
+@override_settings(OVP_CORE={'MAPS_API_LANGUAGE': 'en_US'})
+class SearchQueueTestCase(TestCase):
+  def setUp(self):
+    self.user = User.objects.create_user(email="testmail@test.com", password="test_returned")
+    self.user.save()
+
+    self.project = Project(name="test project", slug="test-slug", details="abc", description="abc", owner=self.user, published=True)
+    self.project.save()
+
+    call_command('clear_index', '--noinput', verbosity=0)
+
+  def queue(self, action, instance):
+    return IndexQueueEntry.objects.create(model=get_model_ct(instance), object_id=instance.pk, action=action)
+
+  def test_queue_is_processed(self):
+    """ Test queued entries are written to the index and deleted """
+    self.queue(IndexQueueEntry.UPDATE, self.project)
+    self.queue(IndexQueueEntry.UPDATE, self.user)
+
+    call_command('process_search_queue', verbosity=0)
+
+    self.assertEqual(IndexQueueEntry.objects.count(), 0)
+    self.assertTrue(SearchQuerySet().models(Project).all().count() == 1)
+    self.assertTrue(SearchQuerySet().models(User).all().count() == 1)
+
+  def test_duplicate_entries_are_coalesced(self):
+    """ Test entries for the same object are processed together and the last action wins """
+    self.queue(IndexQueueEntry.UPDATE, self.project)
+    self.queue(IndexQueueEntry.UPDATE, self.user)
+    self.queue(IndexQueueEntry.UPDATE, self.project)
+    self.queue(IndexQueueEntry.REMOVE, self.project)
+
+    self.assertEqual(search_queue.process_batch(batch_size=1), (3, 0))
+    self.assertEqual(IndexQueueEntry.objects.count(), 1)
+    self.assertTrue(SearchQuerySet().models(Project).all().count() == 0)
+
+  def test_claimed_entries_are_skipped(self):
+    """ Test entries claimed by a worker are not returned to another until the claim expires """
+    first = self.queue(IndexQueueEntry.UPDATE, self.project)
+    second = self.queue(IndexQueueEntry.UPDATE, self.user)
+
+    self.assertEqual([entry.pk for entry in search_queue.claim_pending(batch_size=1)], [first.pk])
+    self.assertEqual([entry.pk for entry in search_queue.claim_pending()], [second.pk])
+    self.assertEqual(search_queue.claim_pending(), [])
+
+    IndexQueueEntry.objects.filter(pk=first.pk).update(available_date=timezone.now())
+    self.assertEqual([entry.pk for entry in search_queue.claim_pending()], [first.pk])
+
+  def test_failed_entries_are_retried_with_backoff(self):
+    """ Test failed entries are rescheduled and given up after max attempts """
+    entry = IndexQueueEntry.objects.create(model='ovp_search.missing', object_id=1, action=IndexQueueEntry.UPDATE)
+
+    self.assertEqual(search_queue.process(), (0, 1))
+    entry.refresh_from_db()
+    self.assertEqual(entry.attempts, 1)
+    self.assertTrue(entry.available_date > timezone.now())
+    self.assertTrue(entry.last_error)
+
+    # Not available yet
+    self.assertEqual(search_queue.process(), (0, 0))
+
+    IndexQueueEntry.objects.filter(pk=entry.pk).update(available_date=timezone.now(), attempts=search_queue.MAX_ATTEMPTS)
+    self.assertEqual(search_queue.process(), (0, 0))
+
+  def test_failed_entries_dont_hold_back_their_batch(self):
+    """ Test only entries that fail are rescheduled, the rest of the batch is processed """
+    bad = IndexQueueEntry.objects.create(model='ovp_search.missing', object_id=1, action=IndexQueueEntry.UPDATE)
+    self.queue(IndexQueueEntry.UPDATE, self.project)
+
+    self.assertEqual(search_queue.process_batch(), (1, 1))
+    self.assertEqual(list(IndexQueueEntry.objects.values_list('pk', flat=True)), [bad.pk])
+    self.assertTrue(SearchQuerySet().models(Project).all().count() == 1)
+
+    bad.refresh_from_db()
+    self.assertEqual(bad.attempts, 1)
+    self.assertTrue("missing" in bad.last_error)
+
+  def test_failed_writes_are_split(self):
+    """ Test objects failing to be written are retried apart from the rest of the batch """
+    project = Project(name="broken project", slug="broken-slug", details="abc", description="abc", owner=self.user, published=True)
+    project.save()
+    call_command('clear_index', '--noinput', verbosity=0)
+
+    self.queue(IndexQueueEntry.UPDATE, self.project)
+    self.queue(IndexQueueEntry.UPDATE, self.user)
+    broken = self.queue(IndexQueueEntry.UPDATE, project)
+
+    index = connections['default'].get_unified_index().get_index(Project)
+    should_update = index.should_update
+
+    def check(obj):
+      if obj.pk == project.pk:
+        raise ValueError("broken")
+      return should_update(obj)
+
+    with mock.patch.object(index, 'should_update', side_effect=check):
+      self.assertEqual(search_queue.process_batch(), (2, 1))
+
+    self.assertEqual(list(IndexQueueEntry.objects.values_list('pk', flat=True)), [broken.pk])
+    self.assertEqual([r.pk for r in SearchQuerySet().models(Project).all()], [str(self.project.pk)])
+    self.assertTrue(SearchQuerySet().models(User).all().count() == 1)
+
+  def test_lost_claims_dont_stop_the_queue(self):
+    """ Test the queue is drained when another worker claims a batch first """
+    self.queue(IndexQueueEntry.UPDATE, self.project)
+    claim_pending = search_queue.claim_pending
+    calls = []
+
+    def lose_first_claim(*args, **kwargs):
+      calls.append(1)
+      return [] if len(calls) == 1 else claim_pending(*args, **kwargs)
+
+    with mock.patch.object(search_queue, 'claim_pending', side_effect=lose_first_claim):
+      self.assertEqual(search_queue.process(), (1, 0))
+
+    self.assertEqual(IndexQueueEntry.objects.count(), 0)
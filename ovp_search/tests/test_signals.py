@@ -1,4 +1,6 @@
-from django.test import TestCase
+from django.apps import apps
+from django.db import transaction
+from django.test import TestCase, TransactionTestCase
 from django.test.utils import override_settings
 from django.core.management import call_command
 
@@ -7,9 +9,36 @@ from ovp_users.models.profile import get_profile_model
 from ovp_projects.models import Project, Job, Work
 from ovp_organizations.models import Organization
 from ovp_core.models import GoogleAddress, Cause, Skill
-from ovp_search.helpers import whoosh_raw
+from ovp_search import compiler
+from ovp_search.models import IndexQueueEntry
+from ovp_search.signals import IndexBatch, TiedModelCoalescingSignalProcessor, TiedModelQueuedSignalProcessor
 
+from haystack import connections, connection_router
+from haystack.backends.whoosh_backend import WhooshSearchBackend
 from haystack.query import SearchQuerySet
+from haystack.utils import get_model_ct
+
+from unittest import mock
+
+
+def by_address_component(model, term):
+  queryset = SearchQuerySet().models(model)
+  return compiler.get_compiler().filter(queryset, 'address_components', [term])
+
+
+class SignalProcessorMixin(object):
+  """ Connects signal_processor_class instead of the processor on HAYSTACK_SIGNAL_PROCESSOR """
+  signal_processor_class = None
+
+  def setUp(self):
+    self.default_processor = apps.get_app_config('haystack').signal_processor
+    self.default_processor.teardown()
+    self.signal_processor = self.signal_processor_class(connections, connection_router)
+
+  def tearDown(self):
+    self.signal_processor.teardown()
+    self.default_processor.setup()
+
 
 @override_settings(OVP_CORE={'MAPS_API_LANGUAGE': 'en_US'})
 class DisponibilityTestCase(TestCase):
@@ -53,6 +82,16 @@ class DisponibilityTestCase(TestCase):
     self.assertTrue(SearchQuerySet().models(Project).all().count() == 0)
     self.assertTrue(SearchQuerySet().models(Project).filter(can_be_done_remotely=True).count() == 0)
 
+  def test_disponibility_without_project(self):
+    """
+    Test Job or Work without a project can be saved and deleted
+    """
+    for disponibility in (Job(can_be_done_remotely=True), Work(can_be_done_remotely=True)):
+      disponibility.save()
+      disponibility.delete()
+
+    self.assertTrue(SearchQuerySet().models(Project).all().count() == 0)
+
 @override_settings(OVP_CORE={'MAPS_API_LANGUAGE': 'en_US'})
 class AddressTestCase(TestCase):
   """
@@ -82,17 +121,17 @@ class AddressTestCase(TestCase):
     project.save()
 
     self.assertTrue(SearchQuerySet().models(Project).all().count() == 1)
-    self.assertTrue(SearchQuerySet().models(Project).filter(address_components__exact=whoosh_raw("São Paulo-administrative_area_level_2")).count() == 1)
+    self.assertTrue(by_address_component(Project, "São Paulo-administrative_area_level_2").count() == 1)
 
     project.address.typed_address = "Campinas, SP - Brazil"
     project.address.save()
 
     self.assertTrue(SearchQuerySet().models(Project).all().count() == 1)
-    self.assertTrue(SearchQuerySet().models(Project).filter(address_components__exact=whoosh_raw("Campinas-administrative_area_level_2")).count() == 1)
+    self.assertTrue(by_address_component(Project, "Campinas-administrative_area_level_2").count() == 1)
 
     project.address.delete()
     self.assertTrue(SearchQuerySet().models(Project).all().count() == 0)
-    self.assertTrue(SearchQuerySet().models(Project).filter(address_components__exact=whoosh_raw("Campinas-administrative_area_level_2")).count() == 0)
+    self.assertTrue(by_address_component(Project, "Campinas-administrative_area_level_2").count() == 0)
 
 
   def test_organization_index_on_address_update(self):
@@ -104,17 +143,30 @@ class AddressTestCase(TestCase):
     organization.save()
 
     self.assertTrue(SearchQuerySet().models(Organization).all().count() == 1)
-    self.assertTrue(SearchQuerySet().models(Organization).filter(address_components__exact=whoosh_raw("São Paulo-administrative_area_level_2")).count() == 1)
+    self.assertTrue(by_address_component(Organization, "São Paulo-administrative_area_level_2").count() == 1)
 
     organization.address.typed_address = "Campinas, SP - Brazil"
     organization.address.save()
 
     self.assertTrue(SearchQuerySet().models(Organization).all().count() == 1)
-    self.assertTrue(SearchQuerySet().models(Organization).filter(address_components__exact=whoosh_raw("Campinas-administrative_area_level_2")).count() == 1)
+    self.assertTrue(by_address_component(Organization, "Campinas-administrative_area_level_2").count() == 1)
 
     organization.address.delete()
     self.assertTrue(SearchQuerySet().models(Organization).all().count() == 0)
-    self.assertTrue(SearchQuerySet().models(Organization).filter(address_components__exact=whoosh_raw("Campinas-administrative_area_level_2")).count() == 0)
+    self.assertTrue(by_address_component(Organization, "Campinas-administrative_area_level_2").count() == 0)
+
+  def test_associated_objects_reindexed_on_address_update(self):
+    """ Test projects and organizations sharing an address are reindexed together """
+    project = Project(name="test project", slug="test-slug", details="abc", description="abc", owner=self.user, address=self.address1, published=True)
+    project.save()
+    organization = Organization(name="test organization", details="abc", owner=self.user, address=self.address1, published=True, type=0)
+    organization.save()
+
+    self.address1.typed_address = "Campinas, SP - Brazil"
+    self.address1.save()
+
+    self.assertTrue(by_address_component(Project, "Campinas-administrative_area_level_2").count() == 1)
+    self.assertTrue(by_address_component(Organization, "Campinas-administrative_area_level_2").count() == 1)
 
 
 @override_settings(OVP_CORE={'MAPS_API_LANGUAGE': 'en_US'})
@@ -138,13 +190,13 @@ class ProjectIndexTestCase(TestCase):
     project.save()
 
     self.assertTrue(SearchQuerySet().models(Project).all().count() == 1)
-    self.assertTrue(SearchQuerySet().models(Project).filter(address_components__exact=whoosh_raw("São Paulo-administrative_area_level_2")).count() == 1)
+    self.assertTrue(by_address_component(Project, "São Paulo-administrative_area_level_2").count() == 1)
 
     project.address = self.address2
     project.save()
 
     self.assertTrue(SearchQuerySet().models(Project).all().count() == 1)
-    self.assertTrue(SearchQuerySet().models(Project).filter(address_components__exact=whoosh_raw("Campinas-administrative_area_level_2")).count() == 1)
+    self.assertTrue(by_address_component(Project, "Campinas-administrative_area_level_2").count() == 1)
 
 
   def test_index_on_causes_update(self):
@@ -194,13 +246,13 @@ class OrganizationIndexTestCase(TestCase):
     organization.save()
 
     self.assertTrue(SearchQuerySet().models(Organization).all().count() == 1)
-    self.assertTrue(SearchQuerySet().models(Organization).filter(address_components__exact=whoosh_raw("São Paulo-administrative_area_level_2")).count() == 1)
+    self.assertTrue(by_address_component(Organization, "São Paulo-administrative_area_level_2").count() == 1)
 
     organization.address = self.address2
     organization.save()
 
     self.assertTrue(SearchQuerySet().models(Organization).all().count() == 1)
-    self.assertTrue(SearchQuerySet().models(Organization).filter(address_components__exact=whoosh_raw("Campinas-administrative_area_level_2")).count() == 1)
+    self.assertTrue(by_address_component(Organization, "Campinas-administrative_area_level_2").count() == 1)
 
 
   def test_index_on_causes_update(self):
@@ -261,3 +313,148 @@ class UserIndexTestCase(TestCase):
     self.assertTrue(SearchQuerySet().models(User).all().count() == 1)
     user.delete()
     self.assertTrue(SearchQuerySet().models(User).all().count() == 0)
+
+
+@override_settings(OVP_CORE={'MAPS_API_LANGUAGE': 'en_US'})
+class IndexBatchTestCase(TestCase):
+  def setUp(self):
+    self.user = User.objects.create_user(email="testmail@test.com", password="test_returned")
+    self.user.save()
+
+    self.project = Project(name="test project", slug="test-slug", details="abc", description="abc", owner=self.user, published=True)
+    self.project.save()
+
+    call_command('clear_index', '--noinput', verbosity=0)
+
+  def test_batch_coalesces_objects(self):
+    """ Test objects added to a batch multiple times are written once, with the last action """
+    batch = IndexBatch(connections, connection_router)
+    batch.add(IndexBatch.UPDATE, Project, [self.project.pk])
+    batch.add(IndexBatch.UPDATE, Project, [self.project.pk])
+    batch.add(IndexBatch.UPDATE, User, [self.user.pk])
+    self.assertEqual(len(batch), 2)
+
+    batch.flush()
+    self.assertEqual(len(batch), 0)
+    self.assertTrue(SearchQuerySet().models(Project).all().count() == 1)
+    self.assertTrue(SearchQuerySet().models(User).all().count() == 1)
+
+    batch.add(IndexBatch.UPDATE, Project, [self.project.pk])
+    batch.add(IndexBatch.REMOVE, Project, [self.project.pk])
+    batch.flush()
+    self.assertTrue(SearchQuerySet().models(Project).all().count() == 0)
+
+  def test_batch_removes_objects_deleted_before_flush(self):
+    """ Test updates for objects no longer in the database remove them from index """
+    batch = IndexBatch(connections, connection_router)
+    batch.add(IndexBatch.UPDATE, Project, [self.project.pk])
+    batch.flush()
+    self.assertTrue(SearchQuerySet().models(Project).all().count() == 1)
+
+    batch.add(IndexBatch.UPDATE, Project, [self.project.pk])
+    Project.objects.filter(pk=self.project.pk).delete()
+    batch.flush()
+    self.assertTrue(SearchQuerySet().models(Project).all().count() == 0)
+
+  def test_batch_touches_objects_once(self):
+    """ Test touched objects get their updated field bumped in a single query on flush """
+    modified_date = Project.objects.get(pk=self.project.pk).modified_date
+
+    batch = IndexBatch(connections, connection_router)
+    batch.touch(Project, [self.project.pk, None])
+    batch.touch(Project, [self.project.pk])
+
+    with self.assertNumQueries(1):
+      batch.flush()
+    self.assertTrue(Project.objects.get(pk=self.project.pk).modified_date > modified_date)
+
+
+@override_settings(OVP_CORE={'MAPS_API_LANGUAGE': 'en_US'})
+class CoalescingSignalProcessorTestCase(SignalProcessorMixin, TransactionTestCase):
+  signal_processor_class = TiedModelCoalescingSignalProcessor
+
+  def setUp(self):
+    super(CoalescingSignalProcessorTestCase, self).setUp()
+    self.user = User.objects.create_user(email="testmail@test.com", password="test_returned")
+    call_command('clear_index', '--noinput', verbosity=0)
+
+  def patch_update(self):
+    return mock.patch.object(IndexBatch, 'update', autospec=True, side_effect=IndexBatch.update)
+
+  def get_updates(self, update, model):
+    return [objects for batch, updated_model, objects in (c[0] for c in update.call_args_list) if updated_model is model]
+
+  def test_changes_are_written_once_on_commit(self):
+    """ Test objects saved several times in a transaction are written once, after commit """
+    with self.patch_update() as update:
+      with transaction.atomic():
+        project = Project(name="test project", slug="test-slug", details="abc", description="abc", owner=self.user, published=True)
+        project.save()
+        project.name = "renamed project"
+        project.save()
+        project.save()
+
+        self.assertEqual(update.call_count, 0)
+        self.assertTrue(SearchQuerySet().models(Project).all().count() == 0)
+
+    self.assertEqual([[obj.pk for obj in objects] for objects in self.get_updates(update, Project)], [[project.pk]])
+    self.assertEqual([r.name for r in SearchQuerySet().models(Project).all()], ["renamed project"])
+
+  def test_rolled_back_changes_are_not_written(self):
+    """ Test nothing is written to the index when the transaction is rolled back """
+    with self.patch_update() as update:
+      with transaction.atomic():
+        Project(name="test project", slug="test-slug", details="abc", description="abc", owner=self.user, published=True).save()
+        transaction.set_rollback(True)
+
+    self.assertEqual(update.call_count, 0)
+    self.assertTrue(SearchQuerySet().models(Project).all().count() == 0)
+
+  def test_changes_outside_transactions_are_written(self):
+    """ Test objects saved on autocommit are written right away """
+    with self.patch_update() as update:
+      project = Project(name="test project", slug="test-slug", details="abc", description="abc", owner=self.user, published=True)
+      project.save()
+      self.assertEqual(len(self.get_updates(update, Project)), 1)
+
+    self.assertTrue(SearchQuerySet().models(Project).all().count() == 1)
+
+    Project.objects.filter(pk=project.pk).delete()
+    self.assertTrue(SearchQuerySet().models(Project).all().count() == 0)
+
+
+@override_settings(OVP_CORE={'MAPS_API_LANGUAGE': 'en_US'})
+class QueuedSignalProcessorTestCase(SignalProcessorMixin, TestCase):
+  signal_processor_class = TiedModelQueuedSignalProcessor
+
+  def setUp(self):
+    super(QueuedSignalProcessorTestCase, self).setUp()
+    self.user = User.objects.create_user(email="testmail@test.com", password="test_returned")
+    self.project = Project(name="test project", slug="test-slug", details="abc", description="abc", owner=self.user, published=True)
+    self.project.save()
+    IndexQueueEntry.objects.all().delete()
+
+  def get_entries(self, model):
+    return list(IndexQueueEntry.objects.filter(model=get_model_ct(model)).order_by('pk').values_list('object_id', 'action'))
+
+  def test_changes_are_queued(self):
+    """ Test saves and deletes only insert queue entries, without writing to the index """
+    with mock.patch.object(WhooshSearchBackend, 'update') as update, mock.patch.object(WhooshSearchBackend, 'remove') as remove:
+      self.project.name = "renamed project"
+      self.project.save()
+      Project.objects.filter(pk=self.project.pk).delete()
+
+    self.assertFalse(update.called)
+    self.assertFalse(remove.called)
+    self.assertEqual(self.get_entries(Project), [(self.project.pk, IndexQueueEntry.UPDATE), (self.project.pk, IndexQueueEntry.REMOVE)])
+
+  def test_related_changes_are_queued(self):
+    """ Test related objects queue the object they're tied to, without bumping its updated field """
+    modified_date = Project.objects.get(pk=self.project.pk).modified_date
+
+    self.signal_processor.touch(Project, [self.project.pk])
+    Job(project=self.project, can_be_done_remotely=True).save()
+    self.project.causes.add(Cause.objects.all().order_by('pk').first())
+
+    self.assertEqual(Project.objects.get(pk=self.project.pk).modified_date, modified_date)
+    self.assertEqual(self.get_entries(Project), [(self.project.pk, IndexQueueEntry.UPDATE)] * 2)
@@ -2,16 +2,28 @@ from django.test import TestCase
 from django.test.utils import override_settings
 from django.core.management import call_command
 from django.core.cache import cache
+from django.utils import timezone
 
 from rest_framework.reverse import reverse
-from rest_framework.test import APIClient
+from rest_framework.request import Request
+from rest_framework.test import APIClient, APIRequestFactory
 
 from ovp_users.models import User
 from ovp_users.models.profile import get_profile_model
-from ovp_projects.models import Project, Job
+from ovp_projects.models import Project, Job, Work
 from ovp_organizations.models import Organization
 from ovp_core.models import GoogleAddress, Cause, Skill
 
+from ovp_search import result_cache
+from ovp_search import hydration
+from ovp_search import filters
+from ovp_search.models import CountryCity
+from ovp_search.query import get_cache_key, normalize, PROJECT_PARAMS
+from ovp_search.views import ProjectSearchResource
+
+from haystack.query import SearchQuerySet
+
+import datetime
 import json
 
 
@@ -83,6 +95,20 @@ def create_sample_organizations():
   organization.save()
 
 
+def set_coordinates(model):
+  """ Set fixed coordinates on sample addresses, geocoding depends on the network """
+  coordinates = {
+    "São paulo, SP - Brazil": (-23.5505, -46.6333),
+    "Campinas, SP - Brazil": (-22.9099, -47.0626),
+    "Santo André, SP - Brazil": (-23.6639, -46.5383),
+    "New york, New york - United States": (40.7128, -74.0060),
+  }
+  for obj in model.objects.all():
+    lat, lng = coordinates[obj.address.typed_address]
+    GoogleAddress.objects.filter(pk=obj.address.pk).update(lat=lat, lng=lng)
+  call_command('rebuild_index', '--noinput', verbosity=0)
+
+
 def create_sample_users():
   user1 = User(name="user one", email="testmail1@test.com", password="test_returned")
   user1.save()
@@ -139,10 +165,13 @@ class ProjectSearchTestCase(TestCase):
     """
     cache.clear()
     response = self.client.get(reverse("search-projects-list"), format="json")
+    self.assertEqual(len(response.data["results"]), 3)
 
-    # Second request should not hit db
-    with self.assertNumQueries(0):
+    # Second request should not hit the search engine, only hydrate the page
+    call_command('clear_index', '--noinput', verbosity=0)
+    with self.assertNumQueries(4):
       response = self.client.get(reverse("search-projects-list"), format="json")
+    self.assertEqual(len(response.data["results"]), 3)
 
   def test_no_filter(self):
     """
@@ -151,6 +180,69 @@ class ProjectSearchTestCase(TestCase):
     response = self.client.get(reverse("search-projects-list"), format="json")
     self.assertEqual(len(response.data["results"]), 3)
 
+  def test_pagination(self):
+    """
+    Test search results are paginated on the search engine
+    """
+    response = self.client.get(reverse("search-projects-list") + "?page_size=2", format="json")
+    self.assertEqual(response.data["count"], 3)
+    self.assertEqual(len(response.data["results"]), 2)
+    self.assertTrue(response.data["next"])
+
+    response = self.client.get(reverse("search-projects-list") + "?page_size=2&page=2", format="json")
+    self.assertEqual(response.data["count"], 3)
+    self.assertEqual(len(response.data["results"]), 1)
+
+    response = self.client.get(reverse("search-projects-list") + "?page_size=2&page=3", format="json")
+    self.assertEqual(response.status_code, 404)
+
+  def test_cursor_pagination(self):
+    """
+    Test search results can be walked by cursor
+    """
+    response = self.client.get(reverse("search-projects-list") + "?page_size=2&cursor=", format="json")
+    self.assertTrue("count" not in response.data)
+    self.assertEqual(len(response.data["results"]), 2)
+    self.assertEqual(response.data["previous"], None)
+    names = [p["name"] for p in response.data["results"]]
+    next_link = response.data["next"]
+
+    response = self.client.get(next_link, format="json")
+    self.assertEqual(len(response.data["results"]), 1)
+    self.assertEqual(response.data["next"], None)
+    self.assertTrue(response.data["previous"])
+    names += [p["name"] for p in response.data["results"]]
+    self.assertEqual(sorted(names), ["test project", "test project2", "test project3"])
+
+    # Cursors are only valid for the query they were created for
+    cursor = response.data["previous"].split("cursor=")[1].split("&")[0]
+    response = self.client.get(reverse("search-projects-list") + "?query=project&cursor=" + cursor, format="json")
+    self.assertEqual(response.status_code, 404)
+
+    response = self.client.get(reverse("search-projects-list") + "?cursor=invalid", format="json")
+    self.assertEqual(response.status_code, 404)
+
+    # Cursors restart at their page if page_size changes
+    response = self.client.get(next_link.replace("page_size=2", "page_size=3"), format="json")
+    self.assertEqual(sorted(p["name"] for p in response.data["results"]), ["test project", "test project2", "test project3"])
+    self.assertEqual(response.data["next"], None)
+
+  def test_facets(self):
+    """
+    Test facet counts are returned along with results
+    """
+    response = self.client.get(reverse("search-projects-list"), format="json")
+    self.assertTrue("facets" not in response.data)
+
+    response = self.client.get(reverse("search-projects-list") + "?facets=causes,skills,invalid&page_size=1", format="json")
+    self.assertEqual(len(response.data["results"]), 1)
+    self.assertEqual(sorted(response.data["facets"].keys()), ["causes", "skills"])
+    self.assertEqual(response.data["facets"]["causes"], {"1": 1, "2": 1, "3": 1})
+    self.assertEqual(response.data["facets"]["skills"], {"1": 1, "2": 1, "4": 1})
+
+    response = self.client.get(reverse("search-projects-list") + "?facets=causes&cause=1", format="json")
+    self.assertEqual(response.data["facets"]["causes"], {"1": 1})
+
   @override_settings(OVP_CORE={'MAPS_API_LANGUAGE': 'en_US'}, OVP_SEARCH={'PROJECTS': {'FILTER_OUT': {'name': 'test project'}}})
   def test_result_hiding(self):
     """
@@ -160,6 +252,96 @@ class ProjectSearchTestCase(TestCase):
     response = self.client.get(reverse("search-projects-list"), format="json")
     self.assertEqual(len(response.data["results"]), 2)
 
+  def test_result_hiding_on_engine(self):
+    """
+    Test exclusions on indexed fields are applied by the search engine
+    """
+    pk = Project.objects.get(name="test project").pk
+    fields = ProjectSearchResource.filter_out_fields
+
+    with self.settings(OVP_SEARCH={'PROJECTS': {'FILTER_OUT': {'pk__in': [pk], 'highlighted': False}}}):
+      self.assertTrue(filters.get_filter_out_query("PROJECTS", fields) is not None)
+
+      cache.clear()
+      response = self.client.get(reverse("search-projects-list"), format="json")
+      self.assertEqual(sorted(p["name"] for p in response.data["results"]), ["test project2", "test project3"])
+
+    with self.settings(OVP_SEARCH={'PROJECTS': {'FILTER_OUT': {'name__startswith': 'test'}}}):
+      self.assertTrue(filters.get_filter_out_query("PROJECTS", fields) is None)
+
+  def test_availability_filter(self):
+    """
+    Test filtering projects by job dates, projects with work are ongoing
+    """
+    job = Project.objects.get(name="test project2").job
+    job.start_date = datetime.datetime(2030, 1, 10, tzinfo=timezone.utc)
+    job.end_date = datetime.datetime(2030, 2, 10, tzinfo=timezone.utc)
+    job.save()
+
+    job = Project.objects.get(name="test project3").job
+    job.start_date = datetime.datetime(2020, 1, 10, tzinfo=timezone.utc)
+    job.end_date = datetime.datetime(2020, 2, 10, tzinfo=timezone.utc)
+    job.save()
+
+    Work(project=Project.objects.get(name="test project"), weekly_hours=5, description="abc").save()
+
+    response = self.client.get(reverse("search-projects-list") + "?start_after=2025-01-01", format="json")
+    self.assertEqual(sorted(p["name"] for p in response.data["results"]), ["test project", "test project2"])
+
+    response = self.client.get(reverse("search-projects-list") + "?end_before=2025-01-01", format="json")
+    self.assertEqual(sorted(p["name"] for p in response.data["results"]), ["test project", "test project3"])
+
+    response = self.client.get(reverse("search-projects-list") + "?start_after=2030-01-01T00:00:00&end_before=2030-03-01", format="json")
+    self.assertEqual(sorted(p["name"] for p in response.data["results"]), ["test project", "test project2"])
+
+    # Invalid dates are ignored
+    response = self.client.get(reverse("search-projects-list") + "?start_after=invalid", format="json")
+    self.assertEqual(len(response.data["results"]), 3)
+
+  def test_radius_filter(self):
+    """
+    Test filtering projects by distance, optionally ordered from the nearest
+    """
+    set_coordinates(Project)
+    center = "?lat=-23.5613&lng=-46.6565"
+
+    response = self.client.get(reverse("search-projects-list") + center + "&radius=10", format="json")
+    self.assertEqual([p["name"] for p in response.data["results"]], ["test project"])
+
+    # Campinas is inside the bounding box of an 80km radius, but not inside the circle
+    response = self.client.get(reverse("search-projects-list") + center + "&radius=80", format="json")
+    self.assertEqual([p["name"] for p in response.data["results"]], ["test project"])
+
+    response = self.client.get(reverse("search-projects-list") + center + "&radius=100&ordering=-distance", format="json")
+    self.assertEqual([p["name"] for p in response.data["results"]], ["test project2", "test project"])
+
+    response = self.client.get(reverse("search-projects-list") + center + "&radius=100&ordering=distance", format="json")
+    self.assertEqual([p["name"] for p in response.data["results"]], ["test project", "test project2"])
+
+    # Incomplete or invalid locations are ignored
+    response = self.client.get(reverse("search-projects-list") + center + "&radius=0", format="json")
+    self.assertEqual(len(response.data["results"]), 3)
+
+  def test_organization_filter(self):
+    """
+    Test filtering projects by organization and not_organization
+    """
+    user = User.objects.get(email="testmail-projects@test.com")
+    address = GoogleAddress(typed_address="São paulo, SP - Brazil")
+    address.save()
+    organization = Organization(name="test organization", details="abc", owner=user, address=address, published=True, type=0)
+    organization.save()
+
+    project = Project.objects.get(name="test project")
+    project.organization = organization
+    project.save()
+
+    response = self.client.get(reverse("search-projects-list") + "?organization={}".format(organization.pk), format="json")
+    self.assertEqual([p["name"] for p in response.data["results"]], ["test project"])
+
+    response = self.client.get(reverse("search-projects-list") + "?not_organization={}".format(organization.pk), format="json")
+    self.assertEqual(sorted(p["name"] for p in response.data["results"]), ["test project2", "test project3"])
+
   def test_publish_filter(self):
     """
     Test searching with publish filter == "true", "false" and "both" return correct projects
@@ -255,6 +437,92 @@ class ProjectSearchTestCase(TestCase):
     response = self.client.get(reverse("search-projects-list") + "?query=project4", format="json")
     self.assertEqual(len(response.data["results"]), 0)
 
+  def test_hydration_keeps_search_order(self):
+    """
+    Test hydrated results keep the order returned by the search engine
+    """
+    pks = list(Project.objects.order_by('-pk').values_list('pk', flat=True))
+    self.assertEqual([p.pk for p in hydration.hydrate(Project.objects.all(), pks)], pks)
+
+    pks = [pks[1], pks[0], pks[2]]
+    self.assertEqual([p.pk for p in hydration.hydrate(Project.objects.all(), pks)], pks)
+
+  def test_hydration_large_lists(self):
+    """
+    Test lists past the IN limit are hydrated without a parameter per primary key
+    """
+    pks = list(Project.objects.order_by('-pk').values_list('pk', flat=True))
+    self.assertEqual([p.pk for p in hydration.hydrate(Project.objects.all(), pks, hydration.VALUES)], pks)
+
+    with self.settings(OVP_SEARCH={'HYDRATION_IN_LIMIT': 1}):
+      self.assertEqual(hydration.get_strategy(Project.objects.all(), 2), hydration.VALUES)
+      self.assertEqual([p.pk for p in hydration.hydrate(Project.objects.all(), [pks[2], pks[0]])], [pks[2], pks[0]])
+
+    # More primary keys than SQLite accepts as parameters
+    pks = pks + list(range(max(pks) + 1, max(pks) + 5000))
+    self.assertEqual(len(hydration.hydrate(Project.objects.all(), pks)), 4)
+
+    # Joined lists compose with further filters, ordering and counts
+    queryset = hydration.hydrate(Project.objects.all(), pks).exclude(name="test project")
+    self.assertEqual(queryset.count(), 3)
+    self.assertEqual([p.name for p in queryset.order_by("-search_position")], ["test project2", "test project3", "test project4"])
+    self.assertEqual(hydration.filter_pks(Project.objects.all(), pks).filter(name="test project").count(), 1)
+
+    # Databases without VALUES fetch chunks of IN queries
+    with self.settings(OVP_SEARCH={'HYDRATION_IN_LIMIT': 2}):
+      self.assertEqual([p.pk for p in hydration.hydrate(Project.objects.all(), pks, hydration.CHUNKED)], pks[:4])
+      self.assertEqual(hydration.filter_pks(Project.objects.all(), pks[:4], hydration.CHUNKED).count(), 4)
+
+  def test_empty_result_gets_cached(self):
+    """
+    Test project search caches empty results
+    """
+    cache.clear()
+    response = self.client.get(reverse("search-projects-list") + "?query=project4", format="json")
+    self.assertEqual(len(response.data["results"]), 0)
+
+    key = get_cache_key("projects", normalize({"query": "project4"}, PROJECT_PARAMS))
+    self.assertEqual(result_cache.get_page(key, 0, 20), (0, [], None, None))
+
+  def test_index_payloads(self):
+    """
+    Test project search responds with payloads stored on the index without querying the database
+    """
+    # Equally scored results have no guaranteed order after rebuild_index
+    by_name = lambda results: sorted(results, key=lambda p: p["name"])
+
+    cache.clear()
+    response = self.client.get(reverse("search-projects-list"), format="json")
+    expected = by_name(json.loads(response.content.decode())["results"])
+
+    with self.settings(OVP_SEARCH={'INDEX_PAYLOADS': True}):
+      call_command('rebuild_index', '--noinput', verbosity=0)
+      cache.clear()
+
+      with self.assertNumQueries(0):
+        response = self.client.get(reverse("search-projects-list"), format="json")
+      self.assertEqual(by_name(json.loads(response.content.decode())["results"]), expected)
+
+  def test_representation_cache(self):
+    """
+    Test project representations are cached and invalidated when projects are reindexed
+    """
+    cache.clear()
+    with self.settings(OVP_SEARCH={'CACHE_REPRESENTATIONS': True}):
+      response = self.client.get(reverse("search-projects-list"), format="json")
+      expected = json.loads(response.content.decode())["results"]
+
+      with self.assertNumQueries(0):
+        response = self.client.get(reverse("search-projects-list"), format="json")
+      self.assertEqual(json.loads(response.content.decode())["results"], expected)
+
+      project = Project.objects.get(name="test project")
+      project.name = "renamed project"
+      project.save()
+
+      response = self.client.get(reverse("search-projects-list"), format="json")
+      self.assertTrue("renamed project" in [p["name"] for p in response.data["results"]])
+
 
 @override_settings(OVP_CORE={'MAPS_API_LANGUAGE': 'en_US'})
 class OrganizationSearchTestCase(TestCase):
@@ -277,10 +545,13 @@ class OrganizationSearchTestCase(TestCase):
     """
     cache.clear()
     response = self.client.get(reverse("search-organizations-list"), format="json")
+    self.assertEqual(len(response.data["results"]), 3)
 
-    # Second request should not hit db
-    with self.assertNumQueries(0):
+    # Second request should not hit the search engine, only hydrate the page
+    call_command('clear_index', '--noinput', verbosity=0)
+    with self.assertNumQueries(2):
       response = self.client.get(reverse("search-organizations-list"), format="json")
+    self.assertEqual(len(response.data["results"]), 3)
 
   def test_no_filter(self):
     """
@@ -342,6 +613,18 @@ class OrganizationSearchTestCase(TestCase):
     response = self.client.get(reverse("search-organizations-list") + '?address={"address_components":[{"types":["country"], "long_name":"United States"}]}', format="json")
     self.assertEqual(len(response.data["results"]), 1)
 
+  def test_radius_filter(self):
+    """
+    Test filtering organizations by distance, optionally ordered from the nearest
+    """
+    set_coordinates(Organization)
+
+    response = self.client.get(reverse("search-organizations-list") + "?lat=-23.6639&lng=-46.5383&radius=50&ordering=distance", format="json")
+    self.assertEqual([o["name"] for o in response.data["results"]], ["test organization2", "test organization"])
+
+    response = self.client.get(reverse("search-organizations-list") + "?lat=40.7&lng=-74&radius=50", format="json")
+    self.assertEqual([o["name"] for o in response.data["results"]], ["test organization3"])
+
   def test_causes_filter(self):
     """
     Test searching with causes filter returns only results filtered by cause
@@ -394,10 +677,13 @@ class UserSearchTestCase(TestCase):
     """
     cache.clear()
     response = self.client.get(reverse("search-users-list"), format="json")
+    self.assertEqual(len(response.data["results"]), 3)
 
-    # Second request should not hit db
-    with self.assertNumQueries(0):
+    # Second request should not hit the search engine, only hydrate the page
+    call_command('clear_index', '--noinput', verbosity=0)
+    with self.assertNumQueries(3):
       response = self.client.get(reverse("search-users-list"), format="json")
+    self.assertEqual(len(response.data["results"]), 3)
 
   def test_no_filter(self):
     """
@@ -496,6 +782,20 @@ class OrderingTestCase(TestCase):
     self.assertEqual(str(response.data["results"][0]["name"]), "a")
 
 
+  def test_ordering_on_search_engine(self):
+    """ Assert ordering by sortable index fields is applied by the search engine """
+    request = Request(APIRequestFactory().get(reverse("search-projects-list"), {"ordering": "-created_date"}))
+    queryset = ProjectSearchResource(request=request, format_kwarg=None).get_queryset()
+    self.assertTrue(isinstance(queryset, SearchQuerySet))
+    self.assertEqual(queryset.query.order_by, ["-created_date"])
+
+    response = self.client.get(reverse("search-projects-list") + "?ordering=created_date", format="json")
+    self.assertEqual([p["name"] for p in response.data["results"]], ["test project", "test project2", "test project3"])
+
+    # Ordering is part of the cache key
+    response = self.client.get(reverse("search-projects-list") + "?ordering=-created_date", format="json")
+    self.assertEqual([p["name"] for p in response.data["results"]], ["test project3", "test project2", "test project"])
+
   def test_ordering_by_relevance(self):
     """ Assert it's possible to order projects by relevance """
     UserProfile = get_profile_model()
@@ -518,6 +818,28 @@ class OrderingTestCase(TestCase):
     self.assertEqual(str(response.data["results"][1]["name"]), "test project")
     self.assertEqual(str(response.data["results"][2]["name"]), "test project2")
 
+  def test_ordering_by_relevance_on_search_engine(self):
+    """ Assert relevance is ranked by the search engine and follows profile changes """
+    UserProfile = get_profile_model()
+    user = User(name="c", email="testproject@engine-relevance.com", password="testpassword")
+    user.save()
+
+    profile = UserProfile(user=user)
+    profile.save()
+    profile.causes.add(Cause.objects.get(pk=2))
+
+    self.client.force_authenticate(user=user)
+    response = self.client.get(reverse("search-projects-list") + "?ordering=-relevance", format="json")
+    self.assertEqual(len(response.data["results"]), 3)
+    self.assertEqual(str(response.data["results"][0]["name"]), "test project2")
+
+    profile.causes.clear()
+    profile.skills.add(Skill.objects.get(pk=2))
+
+    response = self.client.get(reverse("search-projects-list") + "?ordering=-relevance", format="json")
+    self.assertEqual(len(response.data["results"]), 3)
+    self.assertEqual(str(response.data["results"][0]["name"]), "test project3")
+
   def test_ordering_by_relevance_unauthenticated(self):
     """ Assert it's not possible to order projects by relevance while unauthenticated """
     response = self.client.get(reverse("search-projects-list") + "?ordering=-relevance", format="json")
@@ -565,7 +887,36 @@ class CityCountryTestCase(TestCase):
     self.assertEqual(len(response.data["common"]), 1)
     self.assertIn("New York", response.data["common"])
 
-  def test_available_country_cities_cache(self):
+  def test_available_country_cities_single_query(self):
+    client = APIClient()
+
+    with self.assertNumQueries(1):
+      response = client.get(reverse("available-country-cities", ["Brazil"]), format="json")
+    self.assertEqual(response.status_code, 200)
+
+  def test_available_country_cities_updates(self):
+    client = APIClient()
+
+    project = Project.objects.get(name="test project2")
+    project.closed = True
+    project.save()
+
+    response = client.get(reverse("available-country-cities", ["Brazil"]), format="json")
+    self.assertEqual(len(response.data["projects"]), 0)
+    self.assertNotIn("Campinas", response.data["projects"])
+
+    project.closed = False
+    project.save()
+
+    response = client.get(reverse("available-country-cities", ["Brazil"]), format="json")
+    self.assertIn("Campinas", response.data["projects"])
+
+    project.delete()
+
+    response = client.get(reverse("available-country-cities", ["Brazil"]), format="json")
+    self.assertNotIn("Campinas", response.data["projects"])
+
+  def test_rebuild_available_cities(self):
+    CountryCity.objects.all().delete()
+    call_command('rebuild_available_cities', verbosity=0)
     self.test_available_country_cities()
-    self.assertTrue(cache.get("available-cities-{}".format(hash("Brazil"))))
-    self.assertTrue(cache.get("available-cities-{}".format(hash("United States"))))
@@ -0,0 +1,89 @@
+from django.test import TestCase
+from django.test.utils import override_settings
+
+from ovp_users.models import User
+from ovp_projects.models import Project
+from ovp_search.whoosh_backend import BUFFERS, BufferedWhooshSearchBackend, WriteBuffer, get_buffer, get_stats
+
+from haystack import connections
+from haystack.constants import ID
+
+import os
+import shutil
+import tempfile
+
+@override_settings(OVP_CORE={'MAPS_API_LANGUAGE': 'en_US'})
+class BufferedWhooshTestCase(TestCase):
+  def setUp(self):
+    # Buffers are kept per process and connection
+    BUFFERS.pop((os.getpid(), 'default'), None)
+    self.path = tempfile.mkdtemp()
+    self.backend = BufferedWhooshSearchBackend('default', PATH=self.path, BUFFER_SIZE=3, BUFFER_DELAY=60)
+    self.index = connections['default'].get_unified_index().get_index(Project)
+
+    user = User.objects.create_user(email="testmail@test.com", password="test_returned")
+    self.projects = []
+    for i in range(3):
+      project = Project(name="test project", slug="test-slug-{}".format(i), details="abc", description="abc", owner=user, published=True)
+      project.save()
+      self.projects.append(project)
+
+  def tearDown(self):
+    BUFFERS.pop((os.getpid(), 'default'), None)
+    shutil.rmtree(self.path)
+
+  def doc_count(self):
+    return self.backend.index.refresh().doc_count()
+
+  def test_writes_are_buffered(self):
+    """ Test writes are only committed on flush """
+    buffer = get_buffer(self.backend)
+    buffer.size = 10
+
+    self.backend.update(self.index, self.projects[:2])
+    self.backend.update(self.index, self.projects[:1])
+    self.assertEqual(len(buffer), 2)
+    self.assertEqual(self.doc_count(), 0)
+
+    buffer.flush()
+    self.assertEqual(len(buffer), 0)
+    self.assertEqual(self.doc_count(), 2)
+
+    self.backend.remove(self.projects[0])
+    buffer.flush()
+    self.assertEqual(self.doc_count(), 1)
+
+    stats = get_stats()['default']
+    self.assertEqual(stats['flushes'], 2)
+    self.assertEqual(stats['max_batch_size'], 2)
+    self.assertEqual(stats['pending'], 0)
+
+  def test_buffer_flushes_when_full(self):
+    """ Test buffer is committed once it reaches its size """
+    buffer = WriteBuffer(self.backend, size=3, delay=60)
+    self.backend.setup()
+
+    for project in self.projects:
+      buffer.add('ovp_projects.project.{}'.format(project.pk), self.prepare(project))
+
+    self.assertEqual(len(buffer), 0)
+    self.assertEqual(self.doc_count(), 3)
+
+  def prepare(self, obj):
+    document = self.index.full_prepare(obj)
+    document.pop('boost', None)
+    return {key: self.backend._from_python(value) for key, value in document.items()}
+
+  def test_failed_writes_are_kept(self):
+    """ Test documents are put back on the buffer when the write fails """
+    buffer = WriteBuffer(self.backend, size=10, delay=60)
+    self.backend.setup()
+
+    buffer.add('ovp_projects.project.{}'.format(self.projects[0].pk), self.prepare(self.projects[0]))
+    buffer.add('invalid', {ID: 'invalid', 'missing_field': 'abc'})
+    buffer.flush()
+    buffer.timer.cancel()
+
+    self.assertEqual(len(buffer), 2)
+    self.assertEqual(buffer.stats['write_errors'], 1)
+    self.assertEqual(self.doc_count(), 0)
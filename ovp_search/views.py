@@ -12,128 +12,369 @@ from ovp_users.models.profile import get_profile_model, UserProfile
 
 from ovp_search import helpers
 from ovp_search import filters
-
-from django.core.cache import cache
+from ovp_search import query as search_query
+from ovp_search import result_cache
+from ovp_search import hydration
+from ovp_search import payloads
+from ovp_search import representations
+from ovp_search import cities
+from ovp_search import geo
 
 from rest_framework import viewsets
 from rest_framework import mixins
 from rest_framework import response
 from rest_framework import decorators
-from rest_framework import pagination
 
 from haystack.query import SearchQuerySet, SQ
 
+from ovp_search.pagination import DefaultSearchPagination, SearchQuerySetPagination
+
+
+class SearchResourceMixin(object):
+  """
+  Shared behavior for search resources
+
+  get_queryset returns a SearchQuerySet which is paginated on the engine,
+  unless the request needs filters or ordering that only the database
+  can apply. In that case the matching primary keys are cached and a
+  database queryset is returned.
+
+  Results keep the search engine ranking unless ordering is requested.
+  Ordering by fields in sort_fields is applied on the search engine, which
+  maps them to sortable index fields. Whoosh only sorts by a single field.
+
+  Facet counts for fields in facet_fields can be requested with the facets
+  parameter. They are computed on the search engine, so on the database
+  path they don't account for filters only the database applies.
+
+  Resources with index_payloads respond with the representation stored on
+  the index when OVP_SEARCH['INDEX_PAYLOADS'] is enabled. Payloads that
+  can't be shown to the current user are hydrated from the database.
+  With OVP_SEARCH['CACHE_REPRESENTATIONS'], representations missing from
+  the index are looked up on the representation cache first.
+
+  Resources with location_search accept lat, lng and radius. The search
+  engine is filtered by the bounding box of the circle and the candidates
+  by their exact distance, so radius searches always take the database
+  path. Ordering by distance sorts results from the nearest.
+  """
+  cache_prefix = None
+  search_params = None
+  engine_ordering_fields = ()
+  sort_fields = {}
+  facet_fields = ()
+  facet_counts = None
+  index_payloads = False
+  cache_representations = False
+  location_search = False
+  pagination_class = SearchQuerySetPagination
+
+  def get_params(self):
+    params = search_query.normalize(self.request.GET, self.search_params)
+
+    # Unknown facets are ignored, so they don't change the cache key
+    facets = [f for f in params.pop('facets', '').split(',') if f in self.facet_fields]
+    if facets:
+      params['facets'] = ','.join(facets)
+
+    # Ordering on the search engine changes the results cached
+    ordering = self.get_ordering()
+    if ordering:
+      params['ordering'] = ','.join(ordering)
+
+    return params
+
+  def get_facets(self):
+    """ Returns valid facet fields requested """
+    facets = self.get_params().get('facets', None)
+    return facets.split(',') if facets else []
+
+  def get_cache_key(self):
+    return search_query.get_cache_key(self.cache_prefix, self.get_params())
+
+  def get_ordering(self):
+    """ Returns valid ordering fields requested """
+    return self.filter_backends[0]().get_ordering(self.request, None, self) or []
+
+  def get_sort(self):
+    """ Returns index fields to sort the search queryset by, or None if ordering needs the database """
+    ordering = self.get_ordering()
+    if all(field in self.engine_ordering_fields for field in ordering):
+      return []
+
+    sort = []
+    for field in ordering:
+      index_field = self.sort_fields.get(field.lstrip('-'), None)
+      if index_field is None:
+        return None
+      sort.append('-' + index_field if field.startswith('-') else index_field)
+
+    if helpers.is_whoosh_backend() and len(sort) > 1:
+      return None
+
+    return sort
+
+  def needs_database(self, params):
+    return self.get_sort() is None
+
+  def get_location(self, params):
+    """ Returns (lat, lng, radius) for radius searches, or None """
+    return geo.get_location(params) if self.location_search else None
+
+  def get_result_keys(self, queryset, params):
+    """ Returns primary keys matched by the search queryset """
+    location = self.get_location(params)
+    if location:
+      order = bool(set(self.get_ordering()) & set(filters.DistanceOrderingFilter.position_ordering))
+      return geo.within(queryset, location, order=order)
+
+    return [int(pk) for pk in queryset.values_list('pk', flat=True)]
+
+  def hydrate(self, pks):
+    return hydration.hydrate(self.get_hydration_queryset(), pks)
+
+  def use_payloads(self):
+    return self.index_payloads and payloads.is_enabled()
+
+  def use_representation_cache(self):
+    return self.cache_representations and representations.is_enabled()
+
+  def can_use_payload(self, data):
+    """ Whether a stored payload is the representation the current user should get """
+    return True
+
+  def add_payload(self, data, pk, payload):
+    payload = payloads.load(payload)
+    if payload is not None and self.can_use_payload(payload):
+      data[pk] = payloads.absolutize(payload, self.request)
+
+  def render_page(self, pks, stored=None):
+    """
+    Returns representations for pks
+
+    Representations come from payloads stored on the index, if given, then
+    from the representation cache. The ones missing are hydrated.
+    """
+    use_cache = self.use_representation_cache()
+    if stored is None and not use_cache:
+      return self.hydrate(pks)
+
+    data = {}
+    for pk, payload in zip(pks, stored or []):
+      self.add_payload(data, pk, payload)
+
+    missing = [pk for pk in pks if pk not in data]
+    model = self.get_hydration_queryset().model
+    versions = {}
+    if missing and use_cache:
+      cached, versions = representations.get_many(model, missing)
+      for pk, payload in cached.items():
+        self.add_payload(data, pk, payload)
+      missing = [pk for pk in missing if pk not in data]
+
+    if missing:
+      objects = list(self.hydrate(missing))
+
+      if use_cache:
+        rendered = {obj.pk: payloads.render(self.get_serializer_class(), obj) for obj in objects}
+        representations.set_many(model, rendered, versions)
+        for pk, payload in rendered.items():
+          self.add_payload(data, pk, payload)
+
+      for obj in objects:
+        if obj.pk not in data:
+          data[obj.pk] = self.get_serializer(obj).data
+
+    return payloads.PayloadList(data[pk] for pk in pks if pk in data)
+
+  def get_serializer(self, *args, **kwargs):
+    if args and isinstance(args[0], payloads.PayloadList):
+      return payloads.PayloadSerializer(*args, **kwargs)
+    return super(SearchResourceMixin, self).get_serializer(*args, **kwargs)
 
-class DefaultSearchPagination(pagination.PageNumberPagination):
-  page_size = 20
-  page_size_query_param = 'page_size'
-  max_page_size = 30
-
-class OrganizationSearchResource(mixins.ListModelMixin, viewsets.GenericViewSet):
-  serializer_class = OrganizationSearchSerializer
-  filter_backends = (filters.OrderingFilter,)
-  ordering_fields = ('slug', 'name', 'website', 'facebook_page', 'details', 'description', 'type', 'hidden_address')
+  def get_queryset(self):
+    params = self.get_params()
+    queryset = self.get_search_queryset(params)
 
-  pagination_class = DefaultSearchPagination
+    if self.get_location(params) is None and not self.needs_database(params):
+      sort = self.get_sort()
+      return queryset.order_by(*sort) if sort else queryset
 
-  def get_queryset(self):
-    params = self.request.GET
+    key = self.get_cache_key()
+    result_keys = result_cache.get_pks(key)
 
-    key = 'organizations-{}'.format(hash(frozenset(params.items())))
-    cache_ttl = 120
-    result = cache.get(key)
+    facets = self.get_facets()
+    if facets:
+      self.facet_counts = result_cache.get_facets(key)
+      if self.facet_counts is None:
+        self.facet_counts = helpers.facet_counts(helpers.facet(queryset, facets), facets)
+        result_cache.set_facets(key, self.facet_counts)
 
-    if not result:
-      highlighted = params.get('highlighted') == 'true'
-      published = params.get('published', 'true')
+    if result_keys is None:
+      result_keys = self.get_result_keys(queryset, params)
 
-      query = params.get('query', None)
-      cause = params.get('cause', None)
-      address = params.get('address', None)
-      name = params.get('name', None)
+      if self.needs_database(params):
+        result = self.get_database_queryset(params, result_keys)
 
-      queryset = SearchQuerySet().models(Organization)
-      queryset = queryset.filter(highlighted=1) if highlighted else queryset
-      queryset = queryset.filter(content=query) if query else queryset
-      queryset = filters.by_name(queryset, name) if name else queryset
-      queryset = filters.by_published(queryset, published)
-      queryset = filters.by_address(queryset, address) if address else queryset
-      queryset = filters.by_causes(queryset, cause) if cause else queryset
+        # Keep the search engine ranking
+        allowed = set(result.values_list('pk', flat=True))
+        result_keys = [pk for pk in result_keys if pk in allowed]
 
-      result_keys = [q.pk for q in queryset]
-      result = Organization.objects.filter(pk__in=result_keys, deleted=False).prefetch_related('causes').select_related('address').order_by('-highlighted')
-      result = filters.filter_out(result, "ORGANIZATIONS")
-      cache.set(key, result, cache_ttl)
+      result_cache.set_pks(key, result_keys)
 
-    return result
+    return self.hydrate(result_keys)
 
 
-class ProjectSearchResource(mixins.ListModelMixin, viewsets.GenericViewSet):
+class OrganizationSearchResource(SearchResourceMixin, mixins.ListModelMixin, viewsets.GenericViewSet):
+  serializer_class = OrganizationSearchSerializer
+  filter_backends = (filters.DistanceOrderingFilter,)
+  ordering_fields = ('slug', 'name', 'website', 'facebook_page', 'details', 'description', 'type', 'hidden_address', 'distance')
+
+  cache_prefix = 'organizations'
+  search_params = search_query.ORGANIZATION_PARAMS
+  engine_ordering_fields = ('distance', '-distance')
+  facet_fields = ('causes', 'address_components')
+  filter_out_fields = ('owner', 'highlighted', 'published', 'deleted')
+  index_payloads = True
+  cache_representations = True
+  location_search = True
+
+  def get_search_queryset(self, params):
+    highlighted = params.get('highlighted') == 'true'
+    published = params.get('published')
+
+    query = params.get('query', None)
+    cause = params.get('cause', None)
+    address = params.get('address', None)
+    name = params.get('name', None)
+
+    queryset = SearchQuerySet().models(Organization).filter(deleted=0)
+    queryset = queryset.filter(highlighted=1) if highlighted else queryset
+    queryset = queryset.filter(content=query) if query else queryset
+    queryset = filters.by_name(queryset, name) if name else queryset
+    queryset = filters.by_published(queryset, published)
+    queryset = filters.by_address(queryset, address) if address else queryset
+    queryset = filters.by_causes(queryset, cause) if cause else queryset
+    queryset = filters.by_location(queryset, self.get_location(params))
+    queryset = filters.by_filter_out(queryset, "ORGANIZATIONS", self.filter_out_fields)
+
+    return queryset
+
+  def needs_database(self, params):
+    needs_database = super(OrganizationSearchResource, self).needs_database(params)
+    return needs_database or filters.get_filter_out_query("ORGANIZATIONS", self.filter_out_fields) is None
+
+  def get_database_queryset(self, params, pks):
+    result = hydration.filter_pks(Organization.objects.filter(deleted=False), pks)
+    return filters.filter_out(result, "ORGANIZATIONS")
+
+  def get_hydration_queryset(self):
+    return Organization.objects.prefetch_related('causes').select_related('address')
+
+
+class ProjectSearchResource(SearchResourceMixin, mixins.ListModelMixin, viewsets.GenericViewSet):
   serializer_class = ProjectSearchSerializer
   filter_backends = (filters.ProjectRelevanceOrderingFilter,)
-  ordering_fields = ('name', 'slug', 'details', 'description', 'highlighted', 'published_date', 'created_date', 'max_applies', 'minimum_age', 'hidden_address', 'crowdfunding', 'public_project', 'relevance', 'closed', 'job__end_date', 'work')
-
-  pagination_class = DefaultSearchPagination
+  ordering_fields = ('name', 'slug', 'details', 'description', 'highlighted', 'published_date', 'created_date', 'max_applies', 'minimum_age', 'hidden_address', 'crowdfunding', 'public_project', 'relevance', 'closed', 'job__end_date', 'work', 'distance')
+
+  cache_prefix = 'projects'
+  search_params = search_query.PROJECT_PARAMS
+  engine_ordering_fields = ('-relevance', 'distance', '-distance')
+  sort_fields = {
+    'published_date': 'published_date',
+    'created_date': 'created_date',
+    'max_applies': 'max_applies',
+    'minimum_age': 'minimum_age',
+    'highlighted': 'highlighted',
+    'closed': 'closed',
+    'job__end_date': 'job_end_date',
+    'work': 'work',
+  }
+  facet_fields = ('causes', 'skills', 'can_be_done_remotely', 'address_components')
+  filter_out_fields = ('organization', 'owner', 'highlighted', 'published', 'closed', 'deleted')
+  index_payloads = True
+  cache_representations = True
+  location_search = True
+
+  def can_use_payload(self, data):
+    # Hidden addresses are shown to the project owner and organization members
+    return not data.get('hidden_address') or not self.request.user.is_authenticated()
+
+  def include_closed(self):
+    return helpers.get_settings('OVP_PROJECTS').get('DEFAULT_INCLUDE_CLOSED', None)
 
   def get_base_queryset(self, pks = None, closed_clause=None):
     base_queryset = Project.objects.filter(deleted=False)
     # if closed_clause is None:
-    closed_clause = helpers.get_settings('OVP_PROJECTS').get('DEFAULT_INCLUDE_CLOSED', None)
+    closed_clause = self.include_closed()
     base_queryset = base_queryset if closed_clause else base_queryset.filter(closed=False)
     if len(pks) > 0:
-      return base_queryset.filter(pk__in=pks)
+      return hydration.filter_pks(base_queryset, pks)
 
     return base_queryset.filter(pk__in=[])
 
-  def get_queryset(self):
-    params = self.request.GET
-
-    key = 'projects-{}'.format(hash(frozenset(params.items())))
-    cache_ttl = 120
-    result = cache.get(key)
-
-    if not result:
-      query = params.get('query', None)
-      cause = params.get('cause', None)
-      skill = params.get('skill', None)
-      address = params.get('address', None)
-      highlighted = (params.get('highlighted') == 'true')
-      name = params.get('name', None)
-      published = params.get('published', 'true')
-      organization = params.get('organization', None)
-      not_organization = params.get('not_organization', None)
-
-      queryset = SearchQuerySet().models(Project)
-      queryset = queryset.filter(highlighted=1) if highlighted else queryset
-      queryset = queryset.filter(content=query) if query else queryset
-      queryset = filters.by_published(queryset, published)
-      queryset = filters.by_address(queryset, address, project=True)
-      queryset = filters.by_name(queryset, name)
-      queryset = filters.by_skills(queryset, skill)
-      queryset = filters.by_causes(queryset, cause)
-
-      result_keys = [q.pk for q in queryset]
-      if not_organization:
-        org = [o for o in not_organization.split(',')]
-        result = self.get_base_queryset(result_keys).prefetch_related('skills', 'causes').select_related('address', 'owner').exclude(organization__in=org)
-      elif organization:
-        org = [o for o in organization.split(',')]
-        result = self.get_base_queryset(result_keys).prefetch_related('skills', 'causes').select_related('address', 'owner').filter(organization__in=org)
-      else:
-        result = self.get_base_queryset(result_keys).prefetch_related('skills', 'causes').select_related('address', 'owner')
-
-      result = filters.filter_out(result, "PROJECTS")
-      cache.set(key, result, cache_ttl)
-
-    return result
-
-
-class UserSearchResource(mixins.ListModelMixin, viewsets.GenericViewSet):
+  def get_params(self):
+    params = super(ProjectSearchResource, self).get_params()
+
+    # Results ranked by relevance depend on the user affinity
+    if set(self.get_ordering()) & set(filters.ProjectRelevanceOrderingFilter.relevance_ordering):
+      params['relevance'] = filters.get_relevance_affinity(self.request)
+
+    return params
+
+  def get_search_queryset(self, params):
+    query = params.get('query', None)
+    cause = params.get('cause', None)
+    skill = params.get('skill', None)
+    address = params.get('address', None)
+    highlighted = (params.get('highlighted') == 'true')
+    name = params.get('name', None)
+    published = params.get('published')
+    organization = params.get('organization', None)
+    not_organization = params.get('not_organization', None)
+
+    queryset = SearchQuerySet().models(Project).filter(deleted=0)
+    queryset = queryset if self.include_closed() else queryset.filter(closed=0)
+    queryset = queryset.filter(highlighted=1) if highlighted else queryset
+    queryset = queryset.filter(content=query) if query else queryset
+    queryset = filters.by_published(queryset, published)
+    queryset = filters.by_address(queryset, address, project=True)
+    queryset = filters.by_name(queryset, name)
+    queryset = filters.by_skills(queryset, skill)
+    queryset = filters.by_causes(queryset, cause)
+    queryset = filters.by_availability(queryset, params.get('start_after', None), params.get('end_before', None))
+    queryset = filters.by_location(queryset, self.get_location(params))
+    queryset = filters.by_relevance(queryset, params.get('relevance', None))
+    queryset = filters.by_filter_out(queryset, "PROJECTS", self.filter_out_fields)
+
+    if not_organization:
+      queryset = filters.by_organizations(queryset, not_organization, exclude=True)
+    else:
+      queryset = filters.by_organizations(queryset, organization)
+
+    return queryset
+
+  def needs_database(self, params):
+    needs_database = super(ProjectSearchResource, self).needs_database(params)
+    return needs_database or filters.get_filter_out_query("PROJECTS", self.filter_out_fields) is None
+
+  def get_database_queryset(self, params, pks):
+    # Organization filters are applied on the search engine
+    result = self.get_base_queryset(pks)
+    return filters.filter_out(result, "PROJECTS")
+
+  def get_hydration_queryset(self):
+    return Project.objects.prefetch_related('skills', 'causes').select_related('address', 'owner')
+
+
+class UserSearchResource(SearchResourceMixin, mixins.ListModelMixin, viewsets.GenericViewSet):
   serializer_class = get_user_search_serializer()
   filter_backends = (filters.OrderingFilter,)
   ordering_fields = ('slug', 'name')
 
-  pagination_class = DefaultSearchPagination
+  cache_prefix = 'users'
+  search_params = search_query.USER_PARAMS
+  facet_fields = ('causes', 'skills')
 
   def __init__(self, *args, **kwargs):
     self.check_user_search_enabled()
@@ -144,76 +385,38 @@ class UserSearchResource(mixins.ListModelMixin, viewsets.GenericViewSet):
     if not s.get('ENABLE_USER_SEARCH', False):
       raise PermissionDenied
 
-  def get_queryset(self):
-    params = self.request.GET
-    key = 'users-{}'.format(hash(frozenset(params.items())))
-    cache_ttl = 120
-    result = cache.get(key)
-
-    if not result:
-      cause = params.get('cause', None)
-      skill = params.get('skill', None)
-      name = params.get('name', None)
+  def get_search_queryset(self, params):
+    cause = params.get('cause', None)
+    skill = params.get('skill', None)
+    name = params.get('name', None)
 
-      queryset = SearchQuerySet().models(User)
-      queryset = filters.by_skills(queryset, skill)
-      queryset = filters.by_causes(queryset, cause)
-      queryset = filters.by_name(queryset, name)
+    queryset = SearchQuerySet().models(User).filter(public=1)
+    queryset = filters.by_skills(queryset, skill)
+    queryset = filters.by_causes(queryset, cause)
+    queryset = filters.by_name(queryset, name)
 
-      result_keys = [q.pk for q in queryset]
-      related_field_name = get_profile_model()._meta.get_field('user').related_query_name()
+    return queryset
 
-      result = User.objects.filter(pk__in=result_keys, public=True).prefetch_related(related_field_name + '__skills', related_field_name + '__causes').select_related(related_field_name)
-      cache.set(key, result, cache_ttl)
+  def get_database_queryset(self, params, pks):
+    return hydration.filter_pks(User.objects.filter(public=True), pks)
 
-    return result
+  def get_hydration_queryset(self):
+    related_field_name = get_profile_model()._meta.get_field('user').related_query_name()
+    return User.objects.prefetch_related(related_field_name + '__skills', related_field_name + '__causes').select_related(related_field_name)
 
 
 @decorators.api_view(["GET"])
 def query_country_deprecated(request, country):
   # Legacy/deprecated route
-  available_cities = []
+  queryset = SearchQuerySet().models(Project)
+  queryset = filters.get_compiler(queryset).filter(queryset, 'address_components', [u"{}-country".format(country)])
 
-  search_term = helpers.whoosh_raw("{}-country".format(country))
-  queryset = SearchQuerySet().models(Project).filter(address_components__exact=search_term)
-
-  for project in queryset:
-    for comp in project.address_components:
-      if "-administrative_area_level_2" in comp or "-locality" in comp:
-        city_name = comp.replace("-administrative_area_level_2", "").replace("-locality", "")
-        if city_name not in available_cities:
-          available_cities.append(city_name)
-
-  available_cities.sort()
+  counts = helpers.get_facet_counts(queryset, 'address_components')
+  available_cities = sorted(helpers.get_cities(counts))
 
   return response.Response(available_cities)
 
 
 @decorators.api_view(["GET"])
 def available_country_cities(request, country):
-  key = "available-cities-{}".format(hash(country))
-  cache_ttl = 120
-  result = cache.get(key)
-
-  if not result:
-    result = {"projects": [], "organizations": [], "common": []}
-
-    search_term = helpers.whoosh_raw("{}-country".format(country))
-
-    queryset = SearchQuerySet().models(Project).filter(address_components__exact=search_term, published=1, closed=0)
-    projects = helpers.get_cities(queryset)
-
-    queryset = SearchQuerySet().models(Organization).filter(address_components__exact=search_term, published=1)
-    organizations = helpers.get_cities(queryset)
-
-    common = projects & organizations
-    projects = projects - common
-    organizations = organizations - common
-
-    result["common"] = sorted(common)
-    result["projects"] = sorted(projects)
-    result["organizations"] = sorted(organizations)
-
-    cache.set(key, result, cache_ttl)
-
-  return response.Response(result)
+  return response.Response(cities.get_available_cities(country))
@@ -0,0 +1,78 @@
+from django.utils import timezone
+from haystack import connections
+from haystack.utils import get_identifier, get_model_ct
+
+from ovp_search.models import IndexWatermark
+
+from datetime import timedelta
+
+"""
+Incremental index updates
+
+Each run stores a watermark per connection and model. The next run only
+reindexes objects whose updated field is newer than the watermark. Signal
+processors bump the updated field when related objects change.
+"""
+
+BATCH_SIZE = 1000
+
+# Rows committed by transactions that started before the last run
+# may carry an older modification date
+OVERLAP = timedelta(minutes=5)
+
+
+def get_watermark(using, model):
+  try:
+    return IndexWatermark.objects.get(using=using, model=get_model_ct(model)).updated_date
+  except IndexWatermark.DoesNotExist:
+    return None
+
+
+def set_watermark(using, model, date):
+  IndexWatermark.objects.update_or_create(using=using, model=get_model_ct(model), defaults={'updated_date': date})
+
+
+def update(using, model, batch_size=BATCH_SIZE, reset=False):
+  """
+  Reindex objects modified since the last run, returns (updated, removed) counts
+
+  Objects modified since the last run that are no longer part of the index
+  queryset are removed. Everything is reindexed on the first run or when
+  reset is True.
+  """
+  started = timezone.now()
+  index = connections[using].get_unified_index().get_index(model)
+  backend = connections[using].get_backend()
+  updated_field = index.get_updated_field()
+
+  start_date = None
+  if updated_field and not reset:
+    start_date = get_watermark(using, model)
+    start_date = start_date - OVERLAP if start_date else None
+
+  queryset = index.build_queryset(using=using, start_date=start_date).order_by('pk')
+
+  updated = 0
+  last_pk = None
+  while True:
+    batch = queryset.filter(pk__gt=last_pk) if last_pk is not None else queryset
+    objects = list(batch[:batch_size])
+    if not objects:
+      break
+
+    backend.update(index, objects)
+    updated += len(objects)
+    last_pk = objects[-1].pk
+
+  removed = 0
+  if start_date:
+    stale = model._default_manager.filter(**{'{}__gte'.format(updated_field): start_date})
+    stale = stale.exclude(pk__in=index.index_queryset(using=using).values('pk'))
+    for pk in stale.values_list('pk', flat=True):
+      backend.remove(get_identifier(model(pk=pk)))
+      removed += 1
+
+  if updated_field:
+    set_watermark(using, model, started)
+
+  return updated, removed
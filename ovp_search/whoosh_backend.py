@@ -0,0 +1,216 @@
+from haystack.backends.whoosh_backend import WhooshEngine, WhooshSearchBackend
+from haystack.constants import ID
+from haystack.exceptions import SkipDocument
+from haystack.utils import get_identifier
+from haystack.utils import log as logging
+
+from whoosh.index import LockError
+
+from collections import OrderedDict
+import atexit
+import os
+import threading
+import time
+
+"""
+Buffered Whoosh engine
+
+Index writes are buffered per process and committed in batches, when the
+buffer reaches BUFFER_SIZE documents or BUFFER_DELAY seconds after the
+first buffered write. A single writer per process takes the index lock,
+instead of one for every save.
+
+  HAYSTACK_CONNECTIONS = {
+    'default': {
+      'ENGINE': 'ovp_search.whoosh_backend.BufferedWhooshEngine',
+      'PATH': '/path/to/whoosh_index',
+      'BUFFER_SIZE': 100,
+      'BUFFER_DELAY': 1.0,
+      'LOCK_TIMEOUT': 5.0,
+    },
+  }
+
+Searches only see buffered writes after they are committed.
+"""
+
+log = logging.getLogger('ovp_search')
+
+BUFFERS = {}
+BUFFERS_LOCK = threading.Lock()
+
+
+class WriteBuffer(object):
+  """
+  Whoosh documents waiting to be committed
+
+  Documents are keyed by id, so the last update or removal of a document
+  wins. A removal is stored as None.
+  """
+  def __init__(self, backend, size=100, delay=1.0, lock_timeout=5.0):
+    self.backend = backend
+    self.size = size
+    self.delay = delay
+    self.lock_timeout = lock_timeout
+
+    self.lock = threading.Lock()
+    self.flush_lock = threading.Lock()
+    self.documents = OrderedDict()
+    self.timer = None
+    self.stats = {
+      'flushes': 0,
+      'documents': 0,
+      'max_batch_size': 0,
+      'lock_wait': 0.0,
+      'max_lock_wait': 0.0,
+      'lock_errors': 0,
+      'write_errors': 0,
+    }
+
+  def __len__(self):
+    return len(self.documents)
+
+  def add(self, whoosh_id, document):
+    with self.lock:
+      self.documents.pop(whoosh_id, None)
+      self.documents[whoosh_id] = document
+      full = len(self.documents) >= self.size
+      if not full:
+        self.schedule()
+
+    if full:
+      self.flush()
+
+  def schedule(self):
+    """ Flush after delay, unless a flush is already scheduled """
+    if self.timer is None:
+      self.timer = threading.Timer(self.delay, self.flush)
+      self.timer.daemon = True
+      self.timer.start()
+
+  def flush(self):
+    """
+    Commit buffered documents in a single writer
+
+    Documents that fail to be written are put back on the buffer and
+    retried on the next flush. Errors are logged instead of raised, as
+    flushes usually run on the timer thread.
+    """
+    with self.flush_lock:
+      with self.lock:
+        documents, self.documents = self.documents, OrderedDict()
+        if self.timer is not None:
+          self.timer.cancel()
+          self.timer = None
+
+      if not documents:
+        return
+
+      if not self.backend.setup_complete:
+        self.backend.setup()
+
+      started = time.time()
+      try:
+        writer = self.backend.index.refresh().writer(timeout=self.lock_timeout)
+      except LockError:
+        self.stats['lock_errors'] += 1
+        self.restore(documents)
+        log.warning("Could not lock the Whoosh index, %d documents kept on buffer", len(documents))
+        return
+
+      lock_wait = time.time() - started
+
+      try:
+        for whoosh_id, document in documents.items():
+          if document is None:
+            writer.delete_by_term(ID, whoosh_id)
+          else:
+            writer.update_document(**document)
+        writer.commit()
+      except Exception:
+        writer.cancel()
+        self.stats['write_errors'] += 1
+        self.restore(documents)
+        log.exception("Could not write to the Whoosh index, %d documents kept on buffer", len(documents))
+        return
+
+      self.stats['flushes'] += 1
+      self.stats['documents'] += len(documents)
+      self.stats['max_batch_size'] = max(self.stats['max_batch_size'], len(documents))
+      self.stats['lock_wait'] += lock_wait
+      self.stats['max_lock_wait'] = max(self.stats['max_lock_wait'], lock_wait)
+      log.debug("Committed %d documents, waited %.3fs for the index lock", len(documents), lock_wait)
+
+  def restore(self, documents):
+    """ Put documents back on the buffer, without overriding newer writes """
+    with self.lock:
+      for whoosh_id, document in documents.items():
+        if whoosh_id not in self.documents:
+          self.documents[whoosh_id] = document
+      self.schedule()
+
+
+def get_buffer(backend):
+  """ Returns the buffer for a connection on the current process """
+  key = (os.getpid(), backend.connection_alias)
+
+  with BUFFERS_LOCK:
+    if key not in BUFFERS:
+      BUFFERS[key] = WriteBuffer(backend, backend.buffer_size, backend.buffer_delay, backend.lock_timeout)
+    return BUFFERS[key]
+
+
+def get_stats():
+  """ Returns buffer stats for each connection on the current process """
+  pid = os.getpid()
+  return {alias: dict(buffer.stats, pending=len(buffer)) for (buffer_pid, alias), buffer in BUFFERS.items() if buffer_pid == pid}
+
+
+@atexit.register
+def flush_all():
+  pid = os.getpid()
+  for (buffer_pid, alias), buffer in list(BUFFERS.items()):
+    if buffer_pid == pid:
+      buffer.flush()
+
+
+def get_documents(backend, index, objects):
+  """ Yields the Whoosh documents backend writes for objects """
+  for obj in objects:
+    try:
+      document = index.full_prepare(obj)
+    except SkipDocument:
+      continue
+
+    # Document boosts aren't supported by Whoosh
+    document.pop('boost', None)
+    yield {key: backend._from_python(value) for key, value in document.items()}
+
+
+class BufferedWhooshSearchBackend(WhooshSearchBackend):
+  def __init__(self, connection_alias, **connection_options):
+    super(BufferedWhooshSearchBackend, self).__init__(connection_alias, **connection_options)
+    self.buffer_size = connection_options.get('BUFFER_SIZE', 100)
+    self.buffer_delay = connection_options.get('BUFFER_DELAY', 1.0)
+    self.lock_timeout = connection_options.get('LOCK_TIMEOUT', 5.0)
+
+  def update(self, index, iterable, commit=True):
+    if not self.setup_complete:
+      self.setup()
+
+    buffer = get_buffer(self)
+    for document in get_documents(self, index, iterable):
+      buffer.add(document[ID], document)
+
+  def remove(self, obj_or_string, commit=True):
+    if not self.setup_complete:
+      self.setup()
+
+    get_buffer(self).add(get_identifier(obj_or_string), None)
+
+  def clear(self, models=None, commit=True):
+    get_buffer(self).flush()
+    super(BufferedWhooshSearchBackend, self).clear(models, commit)
+
+
+class BufferedWhooshEngine(WhooshEngine):
+  backend = BufferedWhooshSearchBackend